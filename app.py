@@ -1,115 +1,26 @@
 import sys
 import os
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFileDialog, QLabel, QPushButton, QSizePolicy, QWidget, QSlider, QLineEdit, QListView, QComboBox
-from PyQt5.QtGui import QIntValidator, QStandardItemModel, QStandardItem
-import dicom
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QApplication, QFileDialog, QLabel, QPushButton, QSizePolicy, QWidget, QSlider, QLineEdit, QComboBox, QCheckBox
+from PyQt5.QtGui import QIntValidator
 import numpy as np
-from numpy.linalg import inv, norm
-from math import exp, sqrt
-from skimage.filters import threshold_otsu
-from skimage.morphology import reconstruction
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
+from matplotlib import colormaps
+from processing import DicomImages, DicomStudy, FitCache, SliceCache, optimLMTiled, fitLogLinear, fitNNLS, scatterMap, scatterMaps, warmStart, trace
 
 
-class DicomImages():
+class TracedCanvas(FigureCanvas):
 
-    def __init__(self):
-
-        self.images = []
-        self.segmentedImages = []
-        self.acquisitionTimes = []
-        self.defaultTime = -1
-
-
-    def add(self, name_img):
-
-        image = dicom.read_file(name_img).pixel_array
-        acquisitionTime = cleanAcquisitionTimes(dicom.read_file(name_img).AcquisitionTime)
-        if self.images == []:
-            self.defaultTime = acquisitionTime
-            threshold = threshold_otsu(image)
-            self.mask = image<threshold
-            self.utile = image>=threshold
-            self.shapeImageX = image.shape[0]
-            self.shapeImageY = image.shape[1]
-        self.images.append(image)
-        self.acquisitionTimes.append(round(acquisitionTime-self.defaultTime,6))
-        image = dicom.read_file(name_img).pixel_array
-        image[self.mask] = 0
-        self.segmentedImages.append(image)
-
-
-    def clear(self):
-
-        self.images = []
-        self.segmentedImages = []
-        self.acquisitionTimes = []
-
-
-    def length(self):
-
-        return len(self.images)
-
-
-    def shapeImages(self):
-
-        return [self.shapeImageX, self.shapeImageY]
-
-
-    def element(self, numElement, mode):
-
-        if mode == "normal":
-            return self.images[numElement]
-        elif mode == "segmented":
-            return self.segmentedImages[numElement]
-
-
-    def valuePixel(self, numElement, posX, posY, mode):
-
-        sizeY, sizeX = self.images[numElement].shape
-        if mode == "normal":
-            value = self.images[numElement][sizeY-posY, posX]
-        elif mode == "segmented":
-            value = self.segmentedImages[numElement][sizeY-posY, posX]
-        return value
+    def draw(self):
 
+        with trace.span("draw", canvas=type(self).__name__):
+            FigureCanvas.draw(self)
 
-    def meanValue(self, numElement, posX1, posY1, posX2, posY2, mode):
 
-        sizeY, sizeX = self.images[numElement].shape
-        if mode == "normal":
-            value = np.mean(self.images[numElement][sizeY-posY2:sizeY-posY1+1,posX1:posX2+1])
-        elif mode == "segmented":
-            value = np.mean(self.segmentedImages[numElement][sizeY-posY2:sizeY-posY1+1,posX1:posX2+1])
-        return value
 
-
-    def pixelUtiles(self):
-
-        self.IUtile = np.zeros((len(self.images),np.sum(self.utile)))
-        for i in range(len(self.images)):
-            self.IUtile[i,:] = self.segmentedImages[i][self.utile]
-            for j in range(np.sum(self.utile)):
-                if self.IUtile[i,j] == 0:
-                    self.IUtile[i,j] = 1
-        return self.IUtile
-
-
-    def indicesPixelUtiles(self):
-
-        return self.utile
-
-
-    def getAcquisitionTimes(self):
-
-        return self.acquisitionTimes
-
-
-
-class PlotDicom(FigureCanvas):
+class PlotDicom(TracedCanvas):
 
     def __init__(self, parent=None, width=2.6, height=2.6, dpi=100):
 
@@ -130,9 +41,16 @@ class PlotDicom(FigureCanvas):
         self.rectangleLock = False
         self.alpha = 1
         self.listPlotPoints = []
-        hsv = plt.get_cmap('hsv')
+        hsv = colormaps['hsv']
         self.colors = hsv(np.linspace(0,1,30))
-        self.listNumPointsRectangle = []
+        self.rectangles = []
+        self.rectanglePatches = []
+        self.patch = None
+        self.background = None
+        self.ax = None
+        self.fig.canvas.mpl_connect('button_press_event', self.onPress)
+        self.fig.canvas.mpl_connect('motion_notify_event', self.onMotion)
+        self.fig.canvas.mpl_connect('button_release_event', self.onRelease)
 
 
     def clear(self):
@@ -145,48 +63,71 @@ class PlotDicom(FigureCanvas):
         self.posX = []
         self.posY = []
         self.listPlotPoints = []
-        self.listNumPointsRectangle = []
+        self.rectangles = []
+        self.rectanglePatches = []
+        self.patch = None
+        self.ax = None
 
 
-    def plotDicom(self, data, title):
+    def plotDicom(self, data, title, clim=None):
 
-        self.axes.tick_params(reset=True)
         self.title = title
         self.data = data
-        self.axes.cla()
-        self.ax = self.axes.imshow(self.data, cmap="gray", extent=[1,self.data.shape[0],1,self.data.shape[1]])
-        self.fig.canvas.mpl_connect('button_press_event', self.onPress)
-        self.fig.canvas.mpl_connect('motion_notify_event', self.onMotion)
-        self.fig.canvas.mpl_connect('button_release_event', self.onRelease)
+        if (self.ax is None) or (self.ax.get_array().shape != self.data.shape):
+            self.axes.tick_params(reset=True)
+            self.axes.cla()
+            self.ax = self.axes.imshow(self.data, cmap="gray", extent=[1,self.data.shape[0],1,self.data.shape[1]])
+            if clim is not None:
+                self.ax.set_clim(*clim)
+            self.rectanglePatches = []
+            if self.pointsMode == "rectangle":
+                for i in range(len(self.rectangles)):
+                    self.addRectangle(self.rectangles[i], self.colors[i % len(self.colors)])
+        else:
+            self.ax.set_data(self.data)
         self.axes.set_title(self.title)
         if self.posX != []:
             if (self.pointsMode == "one") | (self.pointsMode == "multiple"):
                 for i in range(len(self.posX)):
                     drawPos = self.axes.plot(self.posX[i], self.posY[i], color=self.colors[i], marker="+", alpha=self.alpha)
                     self.listPlotPoints.append(drawPos)
-            elif self.pointsMode == "rectangle":
-                for i in range(len(self.listNumPointsRectangle)):
-                    indexEndRectangle = self.listNumPointsRectangle[i]
-                    if i == 0:
-                        indexStartRectangle = 0
-                    else:
-                        indexStartRectangle = self.listNumPointsRectangle[i-1]
-                    drawPos = self.axes.plot(self.posX[indexStartRectangle:indexEndRectangle], self.posY[indexStartRectangle:indexEndRectangle], color=self.colors[i], marker="+", alpha=self.alpha)
-                    self.listPlotPoints.append(drawPos)
         self.draw()
         if self.posX != []:
             if (self.pointsMode == "one") | (self.pointsMode == "multiple"):
                 for i in range(len(self.posX)):
                     self.listPlotPoints[i].pop(0).remove()
-            elif self.pointsMode == "rectangle":
-                for i in range(len(self.listNumPointsRectangle)):
-                    self.listPlotPoints[i].pop(0).remove()
             self.listPlotPoints = []
 
 
+    def addRectangle(self, rectangle, color, animated=False):
+
+        x, y, width, height = self.rectangleBounds(rectangle)
+        patch = Rectangle((x, y), width, height, facecolor=color, edgecolor=color, alpha=0.3, animated=animated)
+        self.axes.add_patch(patch)
+        self.rectanglePatches.append(patch)
+        return patch
+
+
+    def rectangleBounds(self, rectangle):
+
+        x0, y0, x1, y1 = rectangle
+        left, right, bottom, top = self.ax.get_extent()
+        sizeX = (right-left)/self.data.shape[1]
+        sizeY = (top-bottom)/self.data.shape[0]
+        return left+x0*sizeX, bottom+(y0-1)*sizeY, (x1-x0+1)*sizeX, (y1-y0+1)*sizeY
+
+
+    def removeRectangles(self):
+
+        for patch in self.rectanglePatches:
+            patch.remove()
+        self.rectanglePatches = []
+        self.rectangles = []
+
+
     def onPress(self, event):
 
-        if event.inaxes != self.axes: return
+        if (event.inaxes != self.axes) | (self.ax is None): return
         self.display_position = True
         if self.pointsMode == "one":
             self.posX = [int(event.xdata)]
@@ -212,75 +153,34 @@ class PlotDicom(FigureCanvas):
             if self.rectangleLock == False:
                 self.x0 = int(event.xdata)
                 self.y0 = int(event.ydata)
-                self.posX.append(self.x0)
-                self.posY.append(self.y0)
+                self.currentRectangle = (self.x0, self.y0, self.x0, self.y0)
+                self.patch = self.addRectangle(self.currentRectangle, self.colors[len(self.rectangles) % len(self.colors)], animated=True)
+                self.draw()
+                self.background = self.copy_from_bbox(self.axes.bbox)
                 self.rectangleLock = True
 
 
     def onMotion(self, event):
 
-        if event.inaxes != self.axes: return
+        if (event.inaxes != self.axes) | (self.ax is None): return
         if (self.pointsMode == "rectangle") & self.rectangleLock:
-            dx = int(event.xdata) - self.x0
-            dy = int(event.ydata) - self.y0
-            if self.listNumPointsRectangle != []:
-                self.posX = self.posX[:self.listNumPointsRectangle[-1]]
-                self.posY = self.posY[:self.listNumPointsRectangle[-1]]
-            else:
-                self.posX = []
-                self.posY = []
-            if dx >= 0:
-                xBegin = self.x0
-                xEnd = self.x0+dx+1
-            else:
-                xBegin = self.x0+dx
-                xEnd = self.x0+1
-            if dy >= 0:
-                yBegin = self.y0
-                yEnd = self.y0+dy+1
-            else:
-                yBegin = self.y0+dy
-                yEnd = self.y0+1
-            for x in range(xBegin, xEnd):
-                for y in range(yBegin, yEnd):
-                    self.posX.append(x)
-                    self.posY.append(y)
-            if self.listNumPointsRectangle != []:
-                indexStartNewRectangle = self.listNumPointsRectangle[-1]
-            else:
-                indexStartNewRectangle = 0
-            for i in range(len(self.listNumPointsRectangle)):
-                indexEndRectangle = self.listNumPointsRectangle[i]
-                if i == 0:
-                    indexStartRectangle = 0
-                else:
-                    indexStartRectangle = self.listNumPointsRectangle[i-1]
-                drawPos = self.axes.plot(self.posX[indexStartRectangle:indexEndRectangle], self.posY[indexStartRectangle:indexEndRectangle], color=self.colors[i], marker=".", alpha=self.alpha)
-                self.listPlotPoints.append(drawPos)
-            drawPos = self.axes.plot(self.posX[indexStartNewRectangle:], self.posY[indexStartNewRectangle:], color=self.colors[len(self.listNumPointsRectangle)], marker=".", alpha=self.alpha)
-            self.draw()
-            for i in range(len(self.listNumPointsRectangle)):
-                self.listPlotPoints[i].pop(0).remove()
-            self.listPlotPoints = []
-            drawPos.pop(0).remove()
+            x1 = int(event.xdata)
+            y1 = int(event.ydata)
+            self.currentRectangle = (min(self.x0, x1), min(self.y0, y1), max(self.x0, x1), max(self.y0, y1))
+            self.patch.set_bounds(*self.rectangleBounds(self.currentRectangle))
+            self.restore_region(self.background)
+            self.axes.draw_artist(self.patch)
+            self.blit(self.axes.bbox)
 
 
     def onRelease(self, event):
 
         if (self.pointsMode == "rectangle") & self.rectangleLock:
-            self.listNumPointsRectangle.append(len(self.posX))
-            for i in range(len(self.listNumPointsRectangle)):
-                indexEndRectangle = self.listNumPointsRectangle[i]
-                if i == 0:
-                    indexStartRectangle = 0
-                else:
-                    indexStartRectangle = self.listNumPointsRectangle[i-1]
-                drawPos = self.axes.plot(self.posX[indexStartRectangle:indexEndRectangle], self.posY[indexStartRectangle:indexEndRectangle], color=self.colors[i], marker=".", alpha=self.alpha)
-                self.listPlotPoints.append(drawPos)
+            self.rectangles.append(self.currentRectangle)
+            self.patch.set_animated(False)
+            self.patch = None
+            self.background = None
             self.draw()
-            for i in range(len(self.listNumPointsRectangle)):
-                self.listPlotPoints[i].pop(0).remove()
-            self.listPlotPoints = []
             self.rectangleLock = False
 
 
@@ -288,8 +188,8 @@ class PlotDicom(FigureCanvas):
 
         self.posX = []
         self.posY = []
+        self.removeRectangles()
         self.plotDicom(self.data, self.title)
-        self.listNumPointsRectangle = []
 
 
     def modeSwitch(self, mode):
@@ -297,6 +197,7 @@ class PlotDicom(FigureCanvas):
         if self.pointsMode != mode:
             self.posX = []
             self.posY = []
+            self.removeRectangles()
 
         if mode == "one":
             self.pointsMode = "one"
@@ -319,13 +220,13 @@ class PlotDicom(FigureCanvas):
         return self.display_position, self.posX, self.posY
 
 
-    def getListNumPointsRectangle(self):
+    def getRectangles(self):
 
-        return self.listNumPointsRectangle
+        return self.rectangles
 
 
 
-class PlotI0T2(FigureCanvas):
+class PlotI0T2(TracedCanvas):
 
     def __init__(self, parent=None, width=2.6, height=2.6, dpi=100):
 
@@ -370,7 +271,7 @@ class PlotI0T2(FigureCanvas):
         self.axes.clear()
 
 
-class PlotSignal(FigureCanvas):
+class PlotSignal(TracedCanvas):
 
     def __init__(self, parent=None, width=2.6, height=2.6, dpi=100):
 
@@ -383,7 +284,7 @@ class PlotSignal(FigureCanvas):
         FigureCanvas.updateGeometry(self)
 
         self.mode = "one"
-        hsv = plt.get_cmap('hsv')
+        hsv = colormaps['hsv']
         self.colors = hsv(np.linspace(0,1,30))
         self.numPlot = 0
 
@@ -430,21 +331,89 @@ class PlotSignal(FigureCanvas):
 
 
 
+class FitWorker(QObject):
+
+    progress = pyqtSignal(int, float, float)
+    partial = pyqtSignal(object)
+    finished = pyqtSignal(object, float, bool, object)
+
+    def __init__(self, acquisitionTimes, I, lamb, alpha, nExp, b, c, workers, X0=None, engine="LM", **options):
+
+        super().__init__()
+        self.acquisitionTimes = acquisitionTimes
+        self.I = I
+        self.lamb = lamb
+        self.alpha = alpha
+        self.nExp = nExp
+        self.b = b
+        self.c = c
+        self.workers = workers
+        self.X0 = X0
+        self.engine = engine
+        self.options = options
+        self.cancelled = False
+        self.error = None
+
+
+    def run(self):
+
+        X, f, errors = None, float("nan"), None
+        try:
+            if self.engine == "Log-linear":
+                X, f = fitLogLinear(self.acquisitionTimes,self.I,self.nExp)
+            elif self.engine == "NNLS":
+                X, f = fitNNLS(self.acquisitionTimes,self.I,self.nExp)
+            else:
+                X, f, output = optimLMTiled(self.acquisitionTimes,self.I,self.lamb,self.alpha,self.nExp,self.b,self.c,workers=self.workers,fullOutput=True,callback=self.report,X0=self.X0,errors=True,**self.options)
+                errors = {name: output[name] for name in ("rms", "r2", "stdErrors")}
+        except Exception as error:
+            self.error = "{0}: {1}".format(type(error).__name__, error)
+        finally:
+            self.finished.emit(X, f, self.cancelled, errors)
+
+
+    def report(self, iteration, f, fraction, X):
+
+        self.progress.emit(iteration, f, fraction)
+        if X is not None:
+            self.partial.emit(X.copy())
+        return self.cancelled
+
+
+    def cancel(self):
+
+        self.cancelled = True
+
+
+
 class Window(QWidget):
 
     def __init__(self):
 
         super().__init__()
+        self.dicomStudy = DicomStudy(cacheDir=os.environ.get("APP_DICOM_CACHE"))
         self.dicomImages = DicomImages()
+        self.currentSlice = 0
         self.currentImage = 0
         self.segmentationMode = "normal"
         self.hasData = False
         self.nExp = 1
+        self.engine = "LM"
         self.figuresI0 = {}
         self.figuresT2 = {}
         self.figuresError = {}
-        self.mapsI0 = {}
-        self.mapsT2 = {}
+        self.mapsI0 = None
+        self.mapsT2 = None
+        self.X = None
+        self.errors = None
+        self.nWorkers = os.cpu_count()
+        self.fitThread = None
+        self.importWorkers = 8
+        self.fitDtype = np.float64
+        self.memoryBudget = None
+        self.fitCache = FitCache()
+        self.sliceCache = SliceCache(self.dicomImages)
+        self.frameRate = 10
         self.initUI()
 
 
@@ -471,9 +440,36 @@ class Window(QWidget):
         self.segmentedModeButton = QPushButton('Segmented', self)
         self.segmentedModeButton.clicked.connect(self.segmentedModeSwitch)
 
+        self.comboBoxSegmentation = QComboBox()
+        self.comboBoxSegmentation.addItem("Mean echo")
+        self.comboBoxSegmentation.addItem("Max echo")
+        self.comboBoxSegmentation.currentIndexChanged.connect(self.segmentationChanged)
+
+        self.fillHolesBox = QCheckBox("Fill holes", self)
+        self.fillHolesBox.stateChanged.connect(self.segmentationChanged)
+
+        self.importStatsDisplay = QLabel("")
+
+        self.traceBox = QCheckBox("Trace", self)
+        self.traceBox.stateChanged.connect(self.traceSwitch)
+
+        exportTraceButton = QPushButton('Export trace', self)
+        exportTraceButton.clicked.connect(self.exportTrace)
+
+        self.traceStatsDisplay = QLabel("")
+        self.traceStatsDisplay.hide()
+        self.traceTimer = QTimer(self)
+        self.traceTimer.timeout.connect(self.showTraceStats)
+
         self.slider = QSlider(Qt.Horizontal)
         self.slider.setMaximum(0)
         self.slider.valueChanged.connect(self.valueSliderChanged)
+        self.sliderTimer = QTimer(self)
+        self.sliderTimer.setSingleShot(True)
+        self.sliderTimer.setInterval(15)
+        self.sliderTimer.timeout.connect(self.refreshImage)
+        self.cineTimer = QTimer(self)
+        self.cineTimer.timeout.connect(self.cineStep)
 
         self.minSliderDisplay = QLabel("Min : {0}".format(0))
         self.maxSliderDisplay = QLabel("Max : {0}".format(self.slider.maximum()))
@@ -486,6 +482,20 @@ class Window(QWidget):
 
         self.currentValueDisplay = QLabel("Current image : {0}".format(self.currentImage))
 
+        self.sliceText = QLabel("Slice :")
+
+        self.comboBoxSlice = QComboBox()
+        self.comboBoxSlice.currentIndexChanged.connect(self.selectSlice)
+
+        self.playButton = QPushButton('Play', self)
+        self.playButton.clicked.connect(self.cineSwitch)
+
+        self.frameRateText = QLabel("Frames/s :")
+
+        self.defineFrameRate = QLineEdit(str(self.frameRate), self)
+        self.defineFrameRate.setValidator(QIntValidator(1, 100))
+        self.defineFrameRate.returnPressed.connect(self.frameRateTypedByHand)
+
         self.plotImage = PlotDicom(self, width=0.2, height=0.2)
 
         self.plotSignal = PlotSignal(self, width=0.5, height=0.5)
@@ -497,8 +507,23 @@ class Window(QWidget):
         self.comboBoxExp.addItem("3")
         self.comboBoxExp.addItem("4")
         self.comboBoxExp.currentIndexChanged.connect(self.selectionExp)
+        self.comboBoxEngine = QComboBox()
+        self.comboBoxEngine.addItem("LM")
+        self.comboBoxEngine.addItem("Log-linear")
+        self.comboBoxEngine.addItem("NNLS")
+        self.comboBoxEngine.currentIndexChanged.connect(self.selectionEngine)
         self.expGenerateButton = QPushButton('Generate', self)
         self.expGenerateButton.clicked.connect(self.expGenerate)
+        self.warmStartBox = QCheckBox("Warm start", self)
+        self.stdErrorsBox = QCheckBox("Std errors", self)
+        self.stdErrorsBox.stateChanged.connect(self.refreshMaps)
+        self.fitProgressDisplay = QLabel("")
+        self.float32Box = QCheckBox("Float32", self)
+        self.float32Box.stateChanged.connect(self.selectionDtype)
+        self.memoryBudgetText = QLabel("Memory budget (MB) :")
+        self.defineMemoryBudget = QLineEdit("", self)
+        self.defineMemoryBudget.setValidator(QIntValidator(0, 10**6))
+        self.defineMemoryBudget.editingFinished.connect(self.memoryBudgetTypedByHand)
 
 
         self.figuresI0[0] = PlotI0T2(self, width=0.5, height=2)
@@ -507,28 +532,6 @@ class Window(QWidget):
         self.figuresT2[0] = PlotI0T2(self, width=0.5, height=2)
         self.figuresT2[0].setFixedWidth(200)
         self.figuresT2[0].setFixedHeight(200)
-        self.figuresI0[1] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresI0[1].setFixedWidth(200)
-        self.figuresI0[1].setFixedHeight(200)
-        self.figuresT2[1] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresT2[1].setFixedWidth(200)
-        self.figuresT2[1].setFixedHeight(200)
-        self.figuresI0[2] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresI0[2].setFixedWidth(200)
-        self.figuresI0[2].setFixedHeight(200)
-        self.figuresT2[2] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresT2[2].setFixedWidth(200)
-        self.figuresT2[2].setFixedHeight(200)
-        self.figuresI0[3] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresI0[3].setFixedWidth(200)
-        self.figuresI0[3].setFixedHeight(200)
-        self.figuresT2[3] = PlotI0T2(self, width=0.5, height=2)
-        self.figuresT2[3].setFixedWidth(200)
-        self.figuresT2[3].setFixedHeight(200)
-
-        for k in range(1,4):
-            self.figuresI0[k].hide()
-            self.figuresT2[k].hide()
 
         self.vbox1 = QVBoxLayout()
         self.vbox1.addWidget(importButton)
@@ -538,6 +541,12 @@ class Window(QWidget):
         self.vbox1.addWidget(self.rectangleButton)
         self.vbox1.addWidget(self.clearPositionsButton)
         self.vbox1.addWidget(self.segmentedModeButton)
+        self.vbox1.addWidget(self.comboBoxSegmentation)
+        self.vbox1.addWidget(self.fillHolesBox)
+        self.vbox1.addWidget(self.importStatsDisplay)
+        self.vbox1.addWidget(self.traceBox)
+        self.vbox1.addWidget(exportTraceButton)
+        self.vbox1.addWidget(self.traceStatsDisplay)
 
         self.hbox1 = QHBoxLayout()
         self.hbox1.addWidget(self.minSliderDisplay)
@@ -548,6 +557,11 @@ class Window(QWidget):
         self.hbox2.addWidget(self.changeValueText)
         self.hbox2.addWidget(self.defineValue)
         self.hbox2.addStretch(1)
+        self.hbox2.addWidget(self.sliceText)
+        self.hbox2.addWidget(self.comboBoxSlice)
+        self.hbox2.addWidget(self.playButton)
+        self.hbox2.addWidget(self.frameRateText)
+        self.hbox2.addWidget(self.defineFrameRate)
 
         self.vbox2 = QVBoxLayout()
         self.vbox2.addLayout(self.hbox1)
@@ -560,25 +574,32 @@ class Window(QWidget):
         self.hbox7 = QHBoxLayout()
         self.hbox7.addWidget(self.expText)
         self.hbox7.addWidget(self.comboBoxExp)
+        self.hbox7.addWidget(self.comboBoxEngine)
         self.hbox7.addWidget(self.expGenerateButton)
+        self.hbox7.addWidget(self.warmStartBox)
+        self.hbox7.addWidget(self.stdErrorsBox)
         self.vbox3.addLayout(self.hbox7)
+        self.hbox8 = QHBoxLayout()
+        self.hbox8.addWidget(self.float32Box)
+        self.hbox8.addWidget(self.memoryBudgetText)
+        self.hbox8.addWidget(self.defineMemoryBudget)
+        self.hbox8.addStretch(1)
+        self.vbox3.addLayout(self.hbox8)
+        self.vbox3.addWidget(self.fitProgressDisplay)
         self.hbox3 = QHBoxLayout()
         self.hbox3.addWidget(self.figuresI0[0])
         self.hbox3.addStretch()
         self.hbox3.addWidget(self.figuresT2[0])
         self.vbox3.addLayout(self.hbox3)
         self.hbox4 = QHBoxLayout()
-        self.hbox4.addWidget(self.figuresI0[1])
-        self.hbox4.addWidget(self.figuresT2[1])
         self.vbox3.addLayout(self.hbox4)
         self.hbox5 = QHBoxLayout()
-        self.hbox5.addWidget(self.figuresI0[2])
-        self.hbox5.addWidget(self.figuresT2[2])
         self.vbox3.addLayout(self.hbox5)
         self.hbox6 = QHBoxLayout()
-        self.hbox6.addWidget(self.figuresI0[3])
-        self.hbox6.addWidget(self.figuresT2[3])
         self.vbox3.addLayout(self.hbox6)
+        self.hboxError = QHBoxLayout()
+        self.vbox3.addLayout(self.hboxError)
+        self.hboxMaps = [self.hbox3, self.hbox4, self.hbox5, self.hbox6]
         self.vbox3.addStretch(1)
 
         self.vbox2widget = QWidget()
@@ -605,24 +626,64 @@ class Window(QWidget):
         fname = QFileDialog.getOpenFileNames(self, 'Open file', '/', 'DICOM images (*IMA)')
         if fname[0]:
             self.hasData = True
-            for name_img in fname[0]:
-                self.dicomImages.add(name_img)
-            self.refreshImage()
-            self.slider.setMinimum(0)
-            self.slider.setMaximum(self.dicomImages.length()-1)
-            self.maxSliderDisplay.setText("Max : {0}".format(self.slider.maximum()))
-            self.defineValue.setValidator(QIntValidator(0, self.slider.maximum()))
-            self.slider.setTickInterval(1)
+            stats = self.dicomStudy.addMany(fname[0], workers=self.importWorkers, decode=False)
+            self.importStatsDisplay.setText("{0} files - {1} slices - {2:.1f} files/s - {3:.1f} MB/s".format(stats["files"], stats["slices"], stats["filesPerSecond"], stats["MBPerSecond"]))
+            self.comboBoxSlice.blockSignals(True)
+            self.comboBoxSlice.clear()
+            for series, location in self.dicomStudy.keys:
+                self.comboBoxSlice.addItem("{0:g}".format(location))
+            self.comboBoxSlice.setCurrentIndex(min(self.currentSlice, self.dicomStudy.length()-1))
+            self.comboBoxSlice.blockSignals(False)
+            self.selectSlice(self.comboBoxSlice.currentIndex())
+
+
+    def selectSlice(self, numSlice):
+
+        if (numSlice < 0) | (not self.hasData):
+            return
+        self.discardFit()
+        self.currentSlice = numSlice
+        self.dicomImages = self.dicomStudy.element(numSlice)
+        self.sliceCache.dicomImages = self.dicomImages
+        self.sliceCache.clear()
+        self.X = None
+        self.errors = None
+        self.slider.setMinimum(0)
+        self.slider.setMaximum(self.dicomImages.length()-1)
+        self.maxSliderDisplay.setText("Max : {0}".format(self.slider.maximum()))
+        self.defineValue.setValidator(QIntValidator(0, self.slider.maximum()))
+        self.slider.setTickInterval(1)
+        self.currentImage = min(self.currentImage, self.slider.maximum())
+        self.refreshImage()
+
+
+    def discardFit(self):
+
+        if self.fitThread is not None:
+            self.fitWorker.cancel()
+            self.fitDiscarded = True
 
 
     def clearData(self):
 
+        self.discardFit()
+        self.stopCine()
         self.hasData = False
         self.plotImage.clear()
         self.plotSignal.clear()
-        self.dicomImages.clear()
+        self.dicomStudy.clear()
+        self.dicomImages = DicomImages()
+        self.sliceCache.dicomImages = self.dicomImages
+        self.sliceCache.clear()
+        self.comboBoxSlice.blockSignals(True)
+        self.comboBoxSlice.clear()
+        self.comboBoxSlice.blockSignals(False)
+        self.currentSlice = 0
+        self.X = None
+        self.errors = None
         self.currentImageChanged(0)
         self.maxSliderDisplay.setText("Max : {0}".format(0))
+        self.importStatsDisplay.setText("")
         self.defineValue.setValidator(QIntValidator(0, 0))
 
 
@@ -634,27 +695,16 @@ class Window(QWidget):
         if display_position:
             dataX = range(self.dicomImages.length())
             if (self.plotImage.returnPointsMode() == "one") | (self.plotImage.returnPointsMode() == "multiple"):
-                for i in range(len(posX)):
-                    dataY = []
-                    for element in dataX:
-                        value = self.dicomImages.valuePixel(element, posX[i], posY[i], self.segmentationMode)
-                        dataY.append(value)
-                    legend.append("Pixel ({0},{1})".format(posX[i],posY[i]))
+                points = list(zip(posX, posY))
+                series = self.dicomImages.roiSeries(points=points, mode=self.segmentationMode)
+                for (x, y), dataY in zip(points, series["mean"]):
+                    legend.append("Pixel ({0},{1})".format(x,y))
                     self.plotSignal.plotSig(dataX, dataY, "Evolution of pixel value", legend)
             elif self.plotImage.returnPointsMode() == "rectangle":
-                listNumPointsRectangle = self.plotImage.getListNumPointsRectangle()
-                for i in range(len(listNumPointsRectangle)):
-                    indexEndRectangle = listNumPointsRectangle[i]
-                    if i == 0:
-                        indexStartRectangle = 0
-                    else:
-                        indexStartRectangle = listNumPointsRectangle[i-1]
-                    minPosX, minPosY, maxPosX, maxPosY = min(posX[indexStartRectangle:indexEndRectangle]), min(posY[indexStartRectangle:indexEndRectangle]), max(posX[indexStartRectangle:indexEndRectangle]), max(posY[indexStartRectangle:indexEndRectangle])
-                    dataY = []
-                    for element in dataX:
-                        value = self.dicomImages.meanValue(element, minPosX, minPosY, maxPosX, maxPosY, self.segmentationMode)
-                        dataY.append(value)
-                    legend.append("Mean value ({0},{1}),({2},{3})".format(minPosX,minPosY,maxPosX,maxPosY))
+                rectangles = self.plotImage.getRectangles()
+                series = self.dicomImages.roiSeries(rectangles=rectangles, mode=self.segmentationMode)
+                for (minPosX, minPosY, maxPosX, maxPosY), dataY, count in zip(rectangles, series["mean"], series["count"]):
+                    legend.append("Mean value ({0},{1}),({2},{3}) - {4} px".format(minPosX,minPosY,maxPosX,maxPosY,count))
                     self.plotSignal.plotSig(dataX, dataY, "Evolution", legend)
 
 
@@ -664,7 +714,7 @@ class Window(QWidget):
         self.currentValueDisplay.setText("Current image : {0}".format(self.currentImage))
         self.defineValue.setText(str(self.currentImage))
         if self.hasData:
-            self.refreshImage()
+            self.sliderTimer.start()
 
     def currentImageChanged(self, value):
 
@@ -673,6 +723,39 @@ class Window(QWidget):
         self.currentValueDisplay.setText("Current image : {0}".format(self.currentImage))
 
 
+    def cineSwitch(self):
+
+        if self.cineTimer.isActive():
+            self.stopCine()
+        elif self.hasData & (self.dicomImages.length() > 1):
+            self.cineTimer.start(1000//self.frameRate)
+            self.playButton.setText("Stop")
+
+
+    def stopCine(self):
+
+        self.cineTimer.stop()
+        self.playButton.setText("Play")
+
+
+    def cineStep(self):
+
+        self.currentImage = (self.currentImage+1) % self.dicomImages.length()
+        self.slider.blockSignals(True)
+        self.slider.setValue(self.currentImage)
+        self.slider.blockSignals(False)
+        self.currentValueDisplay.setText("Current image : {0}".format(self.currentImage))
+        self.defineValue.setText(str(self.currentImage))
+        self.refreshImage()
+
+
+    def frameRateTypedByHand(self):
+
+        self.frameRate = int(self.defineFrameRate.text())
+        if self.cineTimer.isActive():
+            self.cineTimer.start(1000//self.frameRate)
+
+
     def valueTypedByHand(self):
 
         value = int(self.defineValue.text())
@@ -715,9 +798,28 @@ class Window(QWidget):
             self.refreshImage()
 
 
+    def segmentationChanged(self):
+
+        self.discardFit()
+        reduction = "max" if self.comboBoxSegmentation.currentText() == "Max echo" else "mean"
+        self.dicomStudy.setSegmentation(reduction=reduction, fillHoles=self.fillHolesBox.isChecked())
+        self.sliceCache.clear()
+        self.X = None
+        self.errors = None
+        if self.hasData:
+            self.refreshImage()
+
+
     def refreshImage(self):
 
-        self.plotImage.plotDicom(self.dicomImages.element(self.currentImage, self.segmentationMode), "Image {0}".format(self.currentImage))
+        k = self.currentImage
+        n = self.dicomImages.length()
+        self.plotImage.plotDicom(self.sliceCache.get(k, self.segmentationMode), "Image {0}".format(k), clim=(0,1))
+        if self.cineTimer.isActive():
+            neighbours = [(k+i) % n for i in range(1, n)]
+        else:
+            neighbours = [k+1, k-1, k+2, k-2]
+        self.sliceCache.prefetch([i for i in neighbours if 0 <= i < n], self.segmentationMode)
 
 
     def selectionExp(self,i):
@@ -725,41 +827,191 @@ class Window(QWidget):
         self.nExp = int(self.comboBoxExp.currentText())
 
 
+    def selectionEngine(self,i):
+
+        self.engine = self.comboBoxEngine.currentText()
+
+
+    def selectionDtype(self):
+
+        self.fitDtype = np.float32 if self.float32Box.isChecked() else np.float64
+
+
+    def memoryBudgetTypedByHand(self):
+
+        text = self.defineMemoryBudget.text()
+        self.memoryBudget = int(text)*2**20 if text not in ("", "0") else None
+
+
     def expGenerate(self):
 
-        if self.hasData:
-            self.expGenerateButton.setText("Computing...")
-            self.mapsI0 = {}
-            self.mapsT2 = {}
+        if self.fitThread is not None:
+            self.fitWorker.cancel()
+            self.expGenerateButton.setText("Cancelling...")
+        elif self.hasData:
+            self.fitNExp = self.nExp
+            self.fitDiscarded = False
             acquisitionTimes = self.dicomImages.getAcquisitionTimes()
-            I = self.dicomImages.pixelUtiles()
             lamb = 0.1
             alpha = 1
             b = 0.05
             c = 10**(-4)
-            self.X, self.f = optimLM(acquisitionTimes,I,lamb,alpha,self.nExp,b,c)
-            shapeImage = self.dicomImages.shapeImages()
-            mask = self.dicomImages.indicesPixelUtiles()
-            for k in range(self.nExp):
-                self.mapsI0[k] = np.zeros(shapeImage)
-                self.mapsT2[k] = np.zeros(shapeImage)
-            ind = 0
-            for i in range(shapeImage[0]):
-                for j in range(shapeImage[1]):
-                    if mask[i,j]:
-                        for k in range(self.nExp):
-                            self.mapsI0[k][i,j] = self.X[ind,k]
-                            self.mapsT2[k][i,j] = 1000*self.X[ind,k+self.nExp]
-                        ind = ind+1
-            for k in range(self.nExp):
-                self.figuresI0[k].show()
-                self.figuresT2[k].show()
-                self.figuresI0[k].plotI0T2Error(data=self.mapsI0[k], title="Carte des I0_{0}".format(k), colorlabel="")
-                self.figuresT2[k].plotI0T2Error(data=self.mapsT2[k], title="Carte des T2_{0}".format(k), colorlabel="ms")
-            for k in range(self.nExp,4):
+            self.fitKey = self.fitCache.key(self.dicomImages,self.fitNExp,lamb,alpha,b,c,self.engine,self.fitDtype if self.engine == "LM" else np.float64)
+            cached = self.fitCache.get(self.fitKey)
+            if cached is not None:
+                self.X, self.f, self.errors = cached
+                self.showMaps(self.X, self.errors)
+                self.fitProgressDisplay.setText("Done (cached) - f = {0:.4g}".format(self.f))
+                return
+            X0 = None
+            if self.warmStartBox.isChecked() & (self.fitNExp > 1) & (self.engine == "LM"):
+                previous = self.fitCache.get(self.fitKey[:2]+(self.fitNExp-1,)+self.fitKey[3:])
+                if previous is not None:
+                    X0 = warmStart(previous[0],self.fitNExp)
+            self.expGenerateButton.setText("Cancel")
+            self.fitProgressDisplay.setText("Computing...")
+            if self.engine == "LM":
+                I = self.dicomImages.pixelUtiles(dtype=self.fitDtype)
+            else:
+                I = self.dicomImages.pixelUtiles()
+            if self.dicomImages.cacheDir is not None:
+                self.dicomImages.saveCache(self.dicomImages.names)
+            self.fitThread = QThread()
+            self.fitWorker = FitWorker(acquisitionTimes,I,lamb,alpha,self.fitNExp,b,c,self.nWorkers,X0,engine=self.engine,dtype=self.fitDtype,memoryBudget=self.memoryBudget)
+            self.fitWorker.moveToThread(self.fitThread)
+            self.fitThread.started.connect(self.fitWorker.run)
+            self.fitWorker.progress.connect(self.fitProgress)
+            self.fitWorker.partial.connect(self.fitPartial)
+            self.fitWorker.finished.connect(self.fitFinished)
+            self.fitThread.start()
+
+
+    def fitProgress(self, iteration, f, fraction):
+
+        self.fitProgressDisplay.setText("Iteration {0} - f = {1:.4g} - {2:.0%} converged".format(iteration, f, fraction))
+
+
+    def fitPartial(self, X):
+
+        if not self.fitDiscarded:
+            self.showMaps(X)
+
+
+    def fitFinished(self, X, f, cancelled, errors):
+
+        self.fitThread.quit()
+        self.fitThread.wait()
+        self.fitThread = None
+        if self.fitDiscarded:
+            self.expGenerateButton.setText("Generate")
+            self.fitProgressDisplay.setText("")
+            return
+        if X is None:
+            self.fitProgressDisplay.setText("Failed - {0}".format(self.fitWorker.error))
+            self.expGenerateButton.setText("Generate")
+            return
+        self.X, self.f, self.errors = X, f, errors
+        self.showMaps(self.X, self.errors)
+        if not cancelled:
+            self.fitCache.put(self.fitKey, self.X, self.f, self.errors)
+        if cancelled:
+            self.fitProgressDisplay.setText("Cancelled")
+        else:
+            self.fitProgressDisplay.setText("Done - f = {0:.4g}".format(self.f))
+        self.expGenerateButton.setText("Generate")
+
+
+    def showMaps(self, X, errors=None):
+
+        with trace.span("showMaps", nExp=self.fitNExp, errors=errors is not None):
+            self.plotMaps(X, errors)
+
+
+    def plotMaps(self, X, errors):
+
+        mask = self.dicomImages.indicesPixelUtiles()
+        self.mapsI0, self.mapsT2 = scatterMaps(X, mask, self.fitNExp)
+        if (errors is not None) & self.stdErrorsBox.isChecked():
+            mapsI0, mapsT2 = scatterMaps(errors["stdErrors"], mask, self.fitNExp)
+            titles = "Erreur type I0_{0}", "Erreur type T2_{0}"
+        else:
+            mapsI0, mapsT2 = self.mapsI0, self.mapsT2
+            titles = "Carte des I0_{0}", "Carte des T2_{0}"
+        for k in range(self.fitNExp):
+            if k not in self.figuresI0:
+                self.createFigures(k)
+            self.figuresI0[k].show()
+            self.figuresT2[k].show()
+            self.figuresI0[k].plotI0T2Error(data=mapsI0[k], title=titles[0].format(k), colorlabel="")
+            self.figuresT2[k].plotI0T2Error(data=mapsT2[k], title=titles[1].format(k), colorlabel="ms")
+        for k in range(self.fitNExp,4):
+            if k in self.figuresI0:
                 self.figuresI0[k].hide()
                 self.figuresT2[k].hide()
-            self.expGenerateButton.setText("Generate")
+        if errors is not None:
+            if not self.figuresError:
+                self.createErrorFigures()
+            self.figuresError["rms"].show()
+            self.figuresError["r2"].show()
+            self.figuresError["rms"].plotI0T2Error(data=scatterMap(errors["rms"], mask), title="Carte des résidus RMS", colorlabel="")
+            self.figuresError["r2"].plotI0T2Error(data=scatterMap(errors["r2"], mask), title="Carte des R²", colorlabel="")
+        elif self.figuresError:
+            self.figuresError["rms"].hide()
+            self.figuresError["r2"].hide()
+
+
+    def refreshMaps(self):
+
+        if self.X is not None:
+            self.showMaps(self.X, self.errors)
+
+
+    def traceSwitch(self):
+
+        trace.enabled = self.traceBox.isChecked()
+        if trace.enabled:
+            trace.clear()
+            self.traceStatsDisplay.show()
+            self.traceTimer.start(1000)
+        else:
+            self.traceTimer.stop()
+        self.showTraceStats()
+
+
+    def showTraceStats(self):
+
+        lines = []
+        for name, (count, total, longest) in trace.summary().items():
+            lines.append("{0} : {1} x {2:.1f} ms (max {3:.1f} ms)".format(name, count, total/count, longest))
+        self.traceStatsDisplay.setText("\n".join(lines))
+
+
+    def exportTrace(self):
+
+        fname = QFileDialog.getSaveFileName(self, 'Export trace', 'trace.json', 'Chrome trace (*.json)')
+        if fname[0]:
+            trace.export(fname[0])
+
+
+    def createFigures(self, k):
+
+        self.figuresI0[k] = PlotI0T2(self, width=0.5, height=2)
+        self.figuresI0[k].setFixedWidth(200)
+        self.figuresI0[k].setFixedHeight(200)
+        self.figuresT2[k] = PlotI0T2(self, width=0.5, height=2)
+        self.figuresT2[k].setFixedWidth(200)
+        self.figuresT2[k].setFixedHeight(200)
+        self.hboxMaps[k].addWidget(self.figuresI0[k])
+        self.hboxMaps[k].addWidget(self.figuresT2[k])
+
+
+    def createErrorFigures(self):
+
+        for name in ("rms", "r2"):
+            self.figuresError[name] = PlotI0T2(self, width=0.5, height=2)
+            self.figuresError[name].setFixedWidth(200)
+            self.figuresError[name].setFixedHeight(200)
+            self.hboxError.addWidget(self.figuresError[name])
 
 
 
@@ -771,99 +1023,6 @@ def resource_path(relative_path):
 
 
 
-def optimLM(temps,I,lamb,alpha,n_exp,b,c):
-    t = 100*np.asarray(temps)
-    n_pixels = I.shape[1]
-    x = np.ones((10,2))
-    for i in range(10):
-        x[i,0] = t[i]
-    x_transpose = np.transpose(x)
-    w = np.matmul(np.matmul(inv(np.matmul(x_transpose,x)),x_transpose),np.log(I[:10,:]))
-    solu = np.zeros((n_pixels,2))
-    for i in range(n_pixels):
-        solu[i,0] = -1/w[0,i]
-        solu[i,1] = exp(w[1,i])
-    X0 = np.zeros((n_pixels,2*n_exp))
-    for i in range(n_pixels):
-        for j in range(n_exp):
-            X0[i,j] = solu[i,1]/n_exp
-            X0[i,j+n_exp] = solu[i,0]/(2**j)
-    maxIter = 50
-    tolX = 10**(-8)
-    tolG = 10**(-8)
-    tolF = 10**(-8)
-    iteration = 0
-    encore = True
-    X = X0
-    n = len(t)
-    r = np.zeros(I.shape)
-    temp_r = np.zeros(I.shape)
-    g = np.zeros((n_pixels,2*n_exp))
-    d = np.zeros((n_pixels,2*n_exp))
-    J = np.zeros((n_pixels,n,2*n_exp))
-    f = 0
-    while encore:
-        pas = alpha
-        g_d = 0
-        for i in range(n_pixels):
-            temp = 0
-            for j in range(n_exp):
-                I0,T2 = X[i,j],X[i,n_exp+j]
-                temp = temp + I0*np.exp(-np.divide(t,T2))
-                J[i,:,j] = sqrt(2)*np.exp(-np.divide(t,T2))
-                J[i,:,n_exp+j] = sqrt(2)*I0/(T2*T2)*np.multiply(t,np.exp(-np.divide(t,T2)))
-            r[:,i] = sqrt(2)*(temp-I[:,i])
-            J_utile = J[i,:,:]
-            r_utile = r[:,i]
-            J_transpose = np.transpose(J_utile)
-            g[i,:] = np.matmul(J_transpose,r_utile)
-            Jt_J = np.matmul(J_transpose,J_utile)
-            J_diag = np.diag(np.diag(Jt_J))
-            d[i,:] = -np.matmul(inv(Jt_J+lamb*J_diag),g[i,:])
-            if np.matmul(np.transpose(d[i,:]),g[i,:])>0:
-                d[i,:] = -d[i,:]
-            g_d = g_d + np.matmul(np.transpose(d[i,:]),g[i,:])
-        pas_invalide = True
-        f = np.sum(0.5*np.matmul(r,np.transpose(r)))
-        while pas_invalide:
-            new_X = X+pas*d
-            for i in range(n_pixels):
-                temp = 0
-                for j in range(n_exp):
-                    I0,T2 = new_X[i,j],new_X[i,n_exp+j]
-                    temp = temp + I0*np.exp(-np.divide(t,T2))
-                temp_r[:,i] = sqrt(2)*(temp-I[:,i])
-            new_f = np.sum(0.5*np.matmul(temp_r,np.transpose(temp_r)))
-            alpha_g_d = c*pas*g_d
-            if new_f>(f+alpha_g_d):
-                pas = b*pas
-            else:
-                pas_invalide = False
-        iteration = iteration+1
-        if norm(g)<tolG:
-            encore = False
-        if norm(new_X-X)/norm(X)<tolX:
-            encore = False
-        if norm(new_f-f)/norm(f)<tolF:
-            encore = False
-        if iteration>=maxIter:
-            encore = False
-        X = new_X
-        f = new_f
-    X[:,n_exp:] = np.divide(X[:,n_exp:],100)
-    return X, f
-
-
-def cleanAcquisitionTimes(acquisitionTime):
-    hour = float(acquisitionTime[0:2])
-    minutes = float(acquisitionTime[2:4])
-    seconds = float(acquisitionTime[4:6])
-    decim = float(acquisitionTime[7:])*10**(-6)
-    time = hour*3600+minutes*60+seconds+decim
-    return time
-
-
-
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = Window()
@@ -0,0 +1,99 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from processing import DicomStudy, optimLMTiled, fitSlices, fitLogLinear, fitNNLS, scatterMap, scatterMaps, residualRMS, trace
+
+
+def processSeries(directory, output, nExp, engine, dtype, cacheDir, segmentation, tracing=False, memoryBudget=None):
+
+    trace.enabled = tracing
+    trace.clear()
+    start = time.perf_counter()
+    names = sorted(glob.glob(os.path.join(directory, "*.IMA")))
+    if names == []:
+        raise ValueError("No .IMA files in {0}".format(directory))
+    study = DicomStudy(cacheDir=cacheDir)
+    study.setSegmentation(**segmentation)
+    study.addMany(names)
+    def fit(acquisitionTimes, I):
+        if engine == "LM":
+            return optimLMTiled(acquisitionTimes,I,0.1,1,nExp,0.05,10**(-4),workers=1,fullOutput=True,dtype=dtype,memoryBudget=memoryBudget,errors=True)
+        elif engine == "Log-linear":
+            return fitLogLinear(acquisitionTimes,I,nExp)+(None,)
+        elif engine == "NNLS":
+            return fitNNLS(acquisitionTimes,I,nExp)+(None,)
+    maps = OrderedDict()
+    pixels = 0
+    fTotal = 0
+    for numSlice, I, X, f, errors in fitSlices(study, fit, dtype=dtype):
+        images = study.element(numSlice)
+        mask = images.indicesPixelUtiles()
+        mapsI0, mapsT2 = scatterMaps(X, mask, nExp)
+        sliceMaps = {"I0": mapsI0, "T2": mapsT2}
+        if errors is None:
+            sliceMaps["error"] = scatterMap(residualRMS(images.getAcquisitionTimes(), I, X, nExp), mask)
+        else:
+            sliceMaps["error"] = scatterMap(errors["rms"], mask)
+            sliceMaps["r2"] = scatterMap(errors["r2"], mask)
+            sliceMaps["I0Error"], sliceMaps["T2Error"] = scatterMaps(errors["stdErrors"], mask, nExp)
+        for name, data in sliceMaps.items():
+            maps.setdefault(name, []).append(data)
+        pixels += int(np.sum(mask))
+        fTotal += f
+    folder = os.path.join(output, os.path.basename(os.path.normpath(directory)))
+    os.makedirs(folder, exist_ok=True)
+    for name, data in maps.items():
+        np.save(os.path.join(folder, "{0}.npy".format(name)), data[0] if study.length() == 1 else np.stack(data))
+    result = {"series": directory, "output": folder, "files": len(names), "slices": study.length(), "pixels": pixels, "f": float(fTotal), "seconds": time.perf_counter()-start}
+    if tracing:
+        result["trace"] = trace.events
+    return result
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Compute I0, T2 and error maps of DICOM series without the GUI.")
+    parser.add_argument("series", nargs="+", help="directories holding the .IMA files of one series each")
+    parser.add_argument("--nexp", type=int, default=1, choices=[1, 2, 3, 4], help="number of exponentials")
+    parser.add_argument("--engine", default="LM", choices=["LM", "Log-linear", "NNLS"], help="fitting engine")
+    parser.add_argument("--output", default="maps", help="folder receiving one sub-folder of maps per series")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of series processed at once")
+    parser.add_argument("--float32", action="store_true", help="fit in single precision")
+    parser.add_argument("--memory-budget", type=int, default=None, help="memory of the LM fit of one series, in MB")
+    parser.add_argument("--cache-dir", default=None, help="on-disk cache of decoded series")
+    parser.add_argument("--segmentation", default="mean", choices=["mean", "max"], help="echo reduction thresholded by Otsu")
+    parser.add_argument("--fill-holes", action="store_true", help="fill holes of the segmentation mask")
+    parser.add_argument("--min-size", type=int, default=0, help="remove mask components smaller than this many pixels")
+    parser.add_argument("--trace", default=None, help="write a Chrome trace (JSON) of the run to this file")
+    args = parser.parse_args(argv)
+
+    dtype = np.float32 if args.float32 else np.float64
+    memoryBudget = args.memory_budget*2**20 if args.memory_budget else None
+    segmentation = {"reduction": args.segmentation, "fillHoles": args.fill_holes, "minSize": args.min_size}
+    failed = 0
+    events = []
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = {executor.submit(processSeries, directory, args.output, args.nexp, args.engine, dtype, args.cache_dir, segmentation, args.trace is not None, memoryBudget): directory for directory in args.series}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                events.extend(result.pop("trace", []))
+                print(json.dumps(result), flush=True)
+            except Exception as error:
+                failed += 1
+                print("{0}: {1}".format(futures[future], error), file=sys.stderr, flush=True)
+    if args.trace is not None:
+        trace.events = events
+        trace.export(args.trace)
+    return 1 if failed else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
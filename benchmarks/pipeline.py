@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from processing import DicomImages, optimLMTiled, scatterMaps
+
+
+def phantom(size, echoes, nExp, noise, spacing, seed):
+
+    rng = np.random.default_rng(seed)
+    times = spacing*np.arange(echoes)
+    y, x = np.mgrid[0:size, 0:size]/max(size-1, 1)
+    tissue = (x-0.5)**2+(y-0.5)**2 < 0.4**2
+    I0 = np.zeros((nExp, size, size))
+    T2 = np.ones((nExp, size, size))
+    for k in range(nExp):
+        I0[k] = (500+1000*x)/(k+1)
+        T2[k] = (0.02+0.1*y)*4**k
+    I0[:, ~tissue] = 0
+    signal = np.sum(I0[:,np.newaxis]*np.exp(-times[np.newaxis,:,np.newaxis,np.newaxis]/T2[:,np.newaxis]), axis=0)
+    signal = signal+rng.normal(0, noise, signal.shape)
+    volume = np.clip(np.round(signal), 0, 2**16-1).astype(np.uint16)
+    return times, volume, I0, T2, tissue
+
+
+def writeSeries(directory, times, volume):
+
+    from dicom.dataset import Dataset, FileDataset
+    from dicom.UID import generate_uid, ExplicitVRLittleEndian
+    series = generate_uid()
+    names = []
+    for k, image in enumerate(volume):
+        name = os.path.join(directory, "IM{0:04d}.IMA".format(k))
+        meta = Dataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(name, {}, file_meta=meta, preamble=b"\0"*128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.Modality = "MR"
+        ds.SeriesInstanceUID = series
+        ds.SliceLocation = 0.0
+        ds.InstanceNumber = k+1
+        ds.EchoTime = 1000*times[k]
+        seconds = 12*3600+times[k]
+        ds.AcquisitionTime = "{0:02d}{1:02d}{2:02d}.{3:06d}".format(int(seconds//3600), int(seconds%3600//60), int(seconds%60), int(round(seconds%1*10**6)))
+        ds.Rows, ds.Columns = image.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = image.tobytes()
+        ds.save_as(name)
+        names.append(name)
+    return names
+
+
+def timed(function, runs):
+
+    seconds = []
+    for run in range(runs):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter()-start)
+    return result, {"min": min(seconds), "median": statistics.median(seconds)}
+
+
+def accuracy(X, mask, nExp, I0, T2, tissue):
+
+    fitted = np.transpose(X[:, :nExp])
+    relaxation = np.transpose(X[:, nExp:2*nExp])
+    order = np.argsort(relaxation, axis=0)
+    fitted = np.take_along_axis(fitted, order, axis=0)
+    relaxation = np.take_along_axis(relaxation, order, axis=0)
+    inside = tissue[mask]
+    errorI0 = np.abs(fitted[:, inside]/I0[:, mask][:, inside]-1)
+    errorT2 = np.abs(relaxation[:, inside]/T2[:, mask][:, inside]-1)
+    return {"pixels": int(np.sum(inside)),
+            "maskRecall": float(np.sum(mask & tissue)/max(np.sum(tissue), 1)),
+            "maskPrecision": float(np.sum(mask & tissue)/max(np.sum(mask), 1)),
+            "I0MedianRelativeError": float(np.nanmedian(errorI0)),
+            "T2MedianRelativeError": float(np.nanmedian(errorT2)),
+            "T2Within10Percent": float(np.mean(errorT2 < 0.1))}
+
+
+def render(volume, runs):
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from app import PlotDicom
+    qapp = QApplication.instance() or QApplication(sys.argv)
+    plot = PlotDicom(None)
+    plot.plotDicom(volume[0], "Image 0")
+    def scroll():
+        for k, image in enumerate(volume):
+            plot.plotDicom(image, "Image {0}".format(k))
+        qapp.processEvents()
+    return timed(scroll, runs)[1]
+
+
+def measure(size, echoes, nExp, noise, spacing, seed, runs, workers, dtype, directory, withRender):
+
+    times, volume, I0, T2, tissue = phantom(size, echoes, nExp, noise, spacing, seed)
+    names = writeSeries(directory, times, volume)
+    stages = {}
+
+    def load():
+        dicomImages = DicomImages()
+        dicomImages.addMany(names)
+        return dicomImages
+    dicomImages, stages["import"] = timed(load, runs)
+    stages["import"]["filesPerSecond"] = len(names)/stages["import"]["min"]
+
+    def segment():
+        dicomImages.mask = None
+        dicomImages.segment()
+    _, stages["segment"] = timed(segment, runs)
+
+    def pixels():
+        dicomImages.IUtile = None
+        return dicomImages.pixelUtiles(dtype=dtype)
+    I, stages["pixelUtiles"] = timed(pixels, runs)
+
+    acquisitionTimes = dicomImages.getAcquisitionTimes()
+    (X, f, output), stages["optimLM"] = timed(lambda: optimLMTiled(acquisitionTimes,I,0.1,1,nExp,0.05,10**(-4),workers=workers,fullOutput=True,dtype=dtype), runs)
+    stages["optimLM"]["pixelsPerSecond"] = I.shape[1]/stages["optimLM"]["min"]
+    stages["optimLM"]["meanIterations"] = float(np.mean(output["iterations"]))
+
+    mask = dicomImages.indicesPixelUtiles()
+    _, stages["maps"] = timed(lambda: scatterMaps(X, mask, nExp), runs)
+    stages["maps"]["pixelsPerSecond"] = I.shape[1]/stages["maps"]["min"]
+
+    if withRender:
+        stages["plotDicom"] = render(dicomImages.images("normal"), runs)
+        stages["plotDicom"]["framesPerSecond"] = echoes/stages["plotDicom"]["min"]
+
+    return {"config": {"size": size, "echoes": echoes, "nExp": nExp, "noise": noise, "spacing": spacing, "seed": seed, "runs": runs, "workers": workers, "dtype": np.dtype(dtype).name},
+            "pixels": int(I.shape[1]),
+            "f": f,
+            "stages": stages,
+            "accuracy": accuracy(X, mask, nExp, I0, T2, tissue)}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Time each stage of the mapping pipeline on a synthetic multi-echo DICOM series with known I0 and T2.")
+    parser.add_argument("--size", type=int, default=128, help="image width and height in pixels")
+    parser.add_argument("--echoes", type=int, default=16, help="number of echoes (at least 10)")
+    parser.add_argument("--nexp", type=int, default=1, choices=[1, 2, 3, 4], help="number of exponentials")
+    parser.add_argument("--noise", type=float, default=5.0, help="standard deviation of the Gaussian noise")
+    parser.add_argument("--spacing", type=float, default=0.01, help="echo spacing in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the noise")
+    parser.add_argument("--runs", type=int, default=3, help="repetitions of each stage")
+    parser.add_argument("--workers", type=int, default=1, help="fitting processes")
+    parser.add_argument("--float32", action="store_true", help="fit in single precision")
+    parser.add_argument("--no-render", action="store_true", help="skip the PlotDicom stage (no PyQt needed)")
+    parser.add_argument("--keep", default=None, help="write the series in this folder and keep it")
+    args = parser.parse_args(argv)
+
+    directory = args.keep or tempfile.mkdtemp(prefix="app_dicom_bench_")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        result = measure(args.size, args.echoes, args.nexp, args.noise, args.spacing, args.seed, args.runs, args.workers, np.float32 if args.float32 else np.float64, directory, not args.no_render)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(result, indent=2))
+
+
+
+if __name__ == "__main__":
+    main()
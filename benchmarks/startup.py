@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import sys
+import time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+from PyQt5.QtWidgets import QApplication
+qapp = QApplication(sys.argv)
+window = app.Window()
+qapp.processEvents()
+shown = time.perf_counter()
+print(imported-start, shown-imported)
+"""
+
+
+def measure(runs):
+
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    imports, windows = [], []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(root=ROOT)], env=env, check=True, capture_output=True, text=True).stdout
+        importTime, windowTime = map(float, output.split()[-2:])
+        imports.append(importTime)
+        windows.append(windowTime)
+    totals = [i+w for i, w in zip(imports, windows)]
+    return {"runs": runs,
+            "import": {"min": min(imports), "median": statistics.median(imports)},
+            "window": {"min": min(windows), "median": statistics.median(windows)},
+            "total": {"min": min(totals), "median": statistics.median(totals)}}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Measure the cold start time of the application in fresh interpreters.")
+    parser.add_argument("--runs", type=int, default=5, help="number of interpreter launches")
+    args = parser.parse_args(argv)
+    print(json.dumps(measure(args.runs), indent=2))
+
+
+
+if __name__ == "__main__":
+    main()
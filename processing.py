@@ -0,0 +1,999 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import numpy as np
+from numpy.linalg import inv, norm
+from math import sqrt
+
+
+class Trace():
+
+    def __init__(self):
+
+        self.enabled = False
+        self.events = []
+        self.idle = contextlib.nullcontext()
+
+
+    def span(self, name, **args):
+
+        if not self.enabled:
+            return self.idle
+        return Span(self, name, args)
+
+
+    def add(self, name, start, stop, **args):
+
+        self.events.append({"name": name, "ph": "X", "ts": start*10**6, "dur": (stop-start)*10**6, "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
+    def clear(self):
+
+        self.events = []
+
+
+    def summary(self):
+
+        stats = OrderedDict()
+        for event in list(self.events):
+            count, total, longest = stats.get(event["name"], (0, 0.0, 0.0))
+            stats[event["name"]] = (count+1, total+event["dur"]/1000, max(longest, event["dur"]/1000))
+        return stats
+
+
+    def export(self, path):
+
+        with open(path, "w") as fh:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fh)
+
+
+
+class Span():
+
+    def __init__(self, trace, name, args):
+
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exception):
+
+        self.trace.add(self.name, self.start, time.perf_counter(), **self.args)
+
+
+
+trace = Trace()
+
+
+
+class DicomImages():
+
+    def __init__(self, cacheDir=None, cacheBudget=2*2**30):
+
+        self.cacheDir = cacheDir
+        self.cacheBudget = cacheBudget
+        self.names = []
+        self.acquisitionTimes = []
+        self.defaultTime = -1
+        self.volume = None
+        self.decoded = None
+        self.count = 0
+        self.mask = None
+        self.utile = None
+        self.IUtile = None
+        self.segmentation = {"reduction": "mean", "fillHoles": False, "minSize": 0}
+
+
+    def add(self, name_img):
+
+        header, image = readDicom(name_img, False)
+        self.append(name_img, header, image)
+
+
+    def addMany(self, names, workers=8, decode=True):
+
+        with trace.span("import", files=len(names), decode=decode):
+            start = time.perf_counter()
+            useCache = (self.cacheDir is not None) & (self.count == 0) & (len(names) > 0)
+            cached = useCache and self.loadCache(names)
+            if not cached:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for name_img, (header, image) in zip(names, executor.map(readDicom, names, [decode]*len(names))):
+                        self.append(name_img, header, image)
+                if useCache & decode:
+                    self.saveCache(names)
+            seconds = max(time.perf_counter()-start, 10**(-9))
+            size = sum(os.path.getsize(name_img) for name_img in names)
+            self.importStats = {"files": len(names), "seconds": seconds, "filesPerSecond": len(names)/seconds, "MBPerSecond": size/seconds/2**20, "cached": cached}
+            return self.importStats
+
+
+    def cacheKey(self, names):
+
+        return cacheKey(names)
+
+
+    def loadCache(self, names):
+
+        path = os.path.join(self.cacheDir, self.cacheKey(names))
+        if not os.path.isdir(path):
+            return False
+        try:
+            volume = np.load(os.path.join(path, "volume.npy"), mmap_mode="r")
+            mask = np.load(os.path.join(path, "mask.npy"))
+            with open(os.path.join(path, "meta.json"), "r") as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        self.names = list(names)
+        self.acquisitionTimes = meta["acquisitionTimes"]
+        self.defaultTime = meta["defaultTime"]
+        self.shapeImageX, self.shapeImageY = volume.shape[1:]
+        self.volume = volume
+        self.count = volume.shape[0]
+        self.decoded = np.ones(self.count, dtype=bool)
+        if meta.get("segmentation") == self.segmentation:
+            self.mask = mask
+            self.utile = ~mask
+        self.IUtile = None
+        return True
+
+
+    def saveCache(self, names):
+
+        path = os.path.join(self.cacheDir, self.cacheKey(names))
+        if os.path.isdir(path):
+            return
+        temporaryPath = "{0}.{1}.tmp".format(path, os.getpid())
+        self.segment()
+        try:
+            os.makedirs(temporaryPath)
+            np.save(os.path.join(temporaryPath, "volume.npy"), self.volume[:self.count])
+            np.save(os.path.join(temporaryPath, "mask.npy"), self.mask)
+            with open(os.path.join(temporaryPath, "meta.json"), "w") as fh:
+                json.dump({"defaultTime": self.defaultTime, "acquisitionTimes": self.acquisitionTimes, "segmentation": self.segmentation}, fh)
+            os.replace(temporaryPath, path)
+        except OSError:
+            shutil.rmtree(temporaryPath, ignore_errors=True)
+            return
+        if self.cacheBudget is not None:
+            evictCache(self.cacheDir, self.cacheBudget, keep=path)
+
+
+    def append(self, name_img, header, image):
+
+        acquisitionTime = cleanAcquisitionTimes(header.AcquisitionTime)
+        if self.count == 0:
+            self.defaultTime = acquisitionTime
+            self.shapeImageX = header.Rows
+            self.shapeImageY = header.Columns
+            dtype = np.dtype("{0}int{1}".format("" if header.PixelRepresentation else "u", header.BitsAllocated))
+            self.volume = np.zeros((8, self.shapeImageX, self.shapeImageY), dtype=dtype)
+            self.decoded = np.zeros(8, dtype=bool)
+        elif self.count == self.volume.shape[0]:
+            volume = np.zeros((2*self.count, self.shapeImageX, self.shapeImageY), dtype=self.volume.dtype)
+            volume[:self.count] = self.volume
+            self.volume = volume
+            self.decoded = np.concatenate([self.decoded, np.zeros(self.count, dtype=bool)])
+        if image is not None:
+            self.volume[self.count] = image
+            self.decoded[self.count] = True
+        self.names.append(name_img)
+        self.acquisitionTimes.append(round(acquisitionTime-self.defaultTime,6))
+        self.count = self.count+1
+        self.mask = None
+        self.utile = None
+        self.IUtile = None
+
+
+    def clear(self):
+
+        self.names = []
+        self.acquisitionTimes = []
+        self.volume = None
+        self.decoded = None
+        self.count = 0
+        self.mask = None
+        self.utile = None
+        self.IUtile = None
+
+
+    def release(self):
+
+        if (self.volume is not None) and not isinstance(self.volume, np.memmap):
+            self.volume = np.zeros(self.volume.shape, dtype=self.volume.dtype)
+            self.decoded[:] = False
+        self.IUtile = None
+
+
+    def length(self):
+
+        return self.count
+
+
+    def shapeImages(self):
+
+        return [self.shapeImageX, self.shapeImageY]
+
+
+    def decode(self, numElement):
+
+        if not self.decoded[numElement]:
+            self.volume[numElement] = readDicom(self.names[numElement], True)[1]
+            self.decoded[numElement] = True
+
+
+    def segment(self):
+
+        if self.mask is None:
+            volume = self.images("normal")
+            with trace.span("segment", **self.segmentation):
+                self.utile = segmentVolume(volume, **self.segmentation)
+            self.mask = ~self.utile
+
+
+    def setSegmentation(self, **options):
+
+        segmentation = dict(self.segmentation, **options)
+        if segmentation != self.segmentation:
+            self.segmentation = segmentation
+            self.mask = None
+            self.utile = None
+            self.IUtile = None
+
+
+    def images(self, mode):
+
+        for i in range(self.count):
+            self.decode(i)
+        if mode == "normal":
+            return self.volume[:self.count]
+        elif mode == "segmented":
+            self.segment()
+            return self.volume[:self.count]*self.utile
+
+
+    def element(self, numElement, mode):
+
+        self.decode(numElement)
+        if mode == "normal":
+            return self.volume[numElement]
+        elif mode == "segmented":
+            self.segment()
+            return np.where(self.mask, 0, self.volume[numElement])
+
+
+    def valuePixel(self, numElement, posX, posY, mode):
+
+        return self.element(numElement, mode)[self.shapeImageX-posY, posX]
+
+
+    def meanValue(self, numElement, posX1, posY1, posX2, posY2, mode):
+
+        sizeY = self.shapeImageX
+        return np.mean(self.element(numElement, mode)[sizeY-posY2:sizeY-posY1+1,posX1:posX2+1])
+
+
+    def roiSeries(self, points=(), rectangles=(), mode="normal"):
+
+        sizeY = self.shapeImageX
+        boxes = [(x, y, x, y) for x, y in points] + list(rectangles)
+        indices = [(np.arange(sizeY-y1, sizeY-y0+1)[:,np.newaxis]*self.shapeImageY + np.arange(x0, x1+1)).ravel() for x0, y0, x1, y1 in boxes]
+        counts = np.array([len(index) for index in indices], dtype=int)
+        if len(boxes) == 0:
+            empty = np.zeros((0, self.count))
+            return {"mean": empty, "median": empty, "std": empty, "count": counts}
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        indices = np.concatenate(indices)
+        block = self.images("normal").reshape(self.count, -1)[:, indices].astype(np.float64)
+        if mode == "segmented":
+            self.segment()
+            block *= self.utile.ravel()[indices]
+        mean = np.add.reduceat(block, starts, axis=1)/counts
+        deviation = block-np.repeat(mean, counts, axis=1)
+        std = np.sqrt(np.add.reduceat(deviation**2, starts, axis=1)/counts)
+        median = np.stack([np.median(group, axis=1) for group in np.split(block, starts[1:], axis=1)], axis=1)
+        return {"mean": mean.T, "median": median.T, "std": std.T, "count": counts}
+
+
+    def pixelUtiles(self, dtype=np.float64):
+
+        self.segment()
+        if (self.IUtile is None) or (self.IUtile.dtype != dtype):
+            volume = self.images("normal")
+            with trace.span("pixelUtiles", pixels=int(np.sum(self.utile)), echoes=self.count):
+                self.IUtile = volume[:, self.utile].astype(dtype)
+                self.IUtile[self.IUtile == 0] = 1
+        return self.IUtile
+
+
+    def indicesPixelUtiles(self):
+
+        self.segment()
+        return self.utile
+
+
+    def getAcquisitionTimes(self):
+
+        return self.acquisitionTimes
+
+
+
+class DicomStudy():
+
+    def __init__(self, cacheDir=None, cacheBudget=2*2**30):
+
+        self.cacheDir = cacheDir
+        self.cacheBudget = cacheBudget
+        self.keys = []
+        self.slices = []
+        self.segmentation = {}
+
+
+    def addMany(self, names, workers=8, decode=False):
+
+        with trace.span("import study", files=len(names), decode=decode):
+            start = time.perf_counter()
+            useCache = (self.cacheDir is not None) & (self.slices == []) & (len(names) > 0)
+            groups = self.loadIndex(names) if useCache else None
+            if groups is None:
+                groups = OrderedDict()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for name_img, (header, image) in zip(names, executor.map(readDicom, names, [decode]*len(names))):
+                        groups.setdefault(sliceKey(header), []).append((echoKey(header), name_img, header, image))
+                groups = OrderedDict((key, [entry[1:] for entry in sorted(group, key=lambda entry: entry[:2])]) for key, group in groups.items())
+                if useCache:
+                    self.saveIndex(names, groups)
+            cached = 0
+            for key, group in groups.items():
+                if key not in self.keys:
+                    self.keys.append(key)
+                    self.slices.append(DicomImages(cacheDir=self.cacheDir, cacheBudget=self.cacheBudget))
+                    self.slices[-1].setSegmentation(**self.segmentation)
+                images = self.slices[self.keys.index(key)]
+                groupNames = [name_img for name_img, header, image in group]
+                if (self.cacheDir is not None) and (images.length() == 0) and images.loadCache(groupNames):
+                    cached += 1
+                elif group[0][1] is None:
+                    images.addMany(groupNames, workers, decode)
+                else:
+                    for name_img, header, image in group:
+                        images.append(name_img, header, image)
+                    if decode and (self.cacheDir is not None):
+                        images.saveCache(groupNames)
+            order = sorted(range(len(self.keys)), key=lambda numSlice: self.keys[numSlice])
+            self.keys = [self.keys[numSlice] for numSlice in order]
+            self.slices = [self.slices[numSlice] for numSlice in order]
+            seconds = max(time.perf_counter()-start, 10**(-9))
+            size = sum(os.path.getsize(name_img) for name_img in names)
+            self.importStats = {"files": len(names), "slices": len(groups), "seconds": seconds, "filesPerSecond": len(names)/seconds, "MBPerSecond": size/seconds/2**20, "cached": (cached > 0) & (cached == len(groups))}
+            return self.importStats
+
+
+    def loadIndex(self, names):
+
+        path = os.path.join(self.cacheDir, "{0}.json".format(cacheKey(names)))
+        try:
+            with open(path, "r") as fh:
+                index = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return OrderedDict(((series, location), [(name_img, None, None) for name_img in group]) for series, location, group in index["slices"])
+
+
+    def saveIndex(self, names, groups):
+
+        path = os.path.join(self.cacheDir, "{0}.json".format(cacheKey(names)))
+        temporaryPath = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with open(temporaryPath, "w") as fh:
+                json.dump({"slices": [[series, location, [name_img for name_img, header, image in group]] for (series, location), group in groups.items()]}, fh)
+            os.replace(temporaryPath, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temporaryPath)
+
+
+    def clear(self):
+
+        self.keys = []
+        self.slices = []
+
+
+    def setSegmentation(self, **options):
+
+        self.segmentation.update(options)
+        for images in self.slices:
+            images.setSegmentation(**options)
+
+
+    def length(self):
+
+        return len(self.slices)
+
+
+    def shape(self):
+
+        if self.slices == []:
+            return [0, 0, 0, 0]
+        return [len(self.slices), max(images.length() for images in self.slices)]+self.slices[0].shapeImages()
+
+
+    def element(self, numSlice):
+
+        return self.slices[numSlice]
+
+
+
+class FitCache():
+
+    def __init__(self, budget=512*2**20):
+
+        self.budget = budget
+        self.entries = OrderedDict()
+
+
+    def key(self, dicomImages, nExp, lamb, alpha, b, c, engine="LM", dtype=np.float64):
+
+        maskKey = hashlib.sha1(np.packbits(dicomImages.indicesPixelUtiles()).tobytes()).hexdigest()
+        return (dicomImages.cacheKey(dicomImages.names), maskKey, nExp, lamb, alpha, b, c, engine, np.dtype(dtype).name)
+
+
+    def get(self, key):
+
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+
+    def put(self, key, X, f, errors=None):
+
+        self.entries[key] = (X, f, errors)
+        self.entries.move_to_end(key)
+        while (len(self.entries) > 1) & (self.size() > self.budget):
+            self.entries.popitem(last=False)
+
+
+    def size(self):
+
+        return sum(X.nbytes+sum(values.nbytes for values in (errors or {}).values()) for X, f, errors in self.entries.values())
+
+
+    def clear(self):
+
+        self.entries.clear()
+
+
+
+class SliceCache():
+
+    def __init__(self, dicomImages, size=8):
+
+        self.dicomImages = dicomImages
+        self.size = size
+        self.buffers = OrderedDict()
+        self.scale = None
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.generation = 0
+        self.executor = None
+
+
+    def clear(self):
+
+        with self.lock:
+            self.buffers.clear()
+            self.scale = None
+            self.epoch += 1
+            self.generation += 1
+
+
+    def build(self, numElement, mode):
+
+        if self.scale is None:
+            first = self.dicomImages.element(0, "normal")
+            low, high = float(first.min()), float(first.max())
+            self.scale = (low, high-low if high > low else 1.0)
+        low, span = self.scale
+        image = self.dicomImages.element(numElement, mode).astype(np.float32)
+        image -= low
+        image /= span
+        return np.clip(image, 0, 1, out=image)
+
+
+    def get(self, numElement, mode):
+
+        key = (numElement, mode)
+        with self.lock:
+            if key in self.buffers:
+                self.buffers.move_to_end(key)
+                return self.buffers[key]
+            epoch = self.epoch
+        buffer = self.build(numElement, mode)
+        with self.lock:
+            if epoch == self.epoch:
+                self.buffers[key] = buffer
+                while len(self.buffers) > self.size:
+                    self.buffers.popitem(last=False)
+        return buffer
+
+
+    def prefetch(self, indices, mode):
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.executor.submit(self.fill, list(indices)[:self.size-1], mode, generation)
+
+
+    def fill(self, indices, mode, generation):
+
+        for numElement in indices:
+            if generation != self.generation:
+                return
+            self.get(numElement, mode)
+
+
+
+def expDecays(t,T2):
+    return np.exp(-np.divide(t,T2[:,:,np.newaxis]))
+
+
+def expModel(X,n_exp,decays):
+    return np.sum(X[:,:n_exp,np.newaxis]*decays,axis=1)
+
+
+def normalEquations(t,X,n_exp,decays,r):
+    I0 = X[:,:n_exp,np.newaxis]
+    T2 = X[:,n_exp:,np.newaxis]
+    dT2 = I0/(T2*T2)*t*decays
+    Jt_J = np.empty((X.shape[0],2*n_exp,2*n_exp),dtype=X.dtype)
+    Jt_J[:,:n_exp,:n_exp] = 2*np.matmul(decays,np.transpose(decays,(0,2,1)))
+    Jt_J[:,:n_exp,n_exp:] = 2*np.matmul(decays,np.transpose(dT2,(0,2,1)))
+    Jt_J[:,n_exp:,:n_exp] = np.transpose(Jt_J[:,:n_exp,n_exp:],(0,2,1))
+    Jt_J[:,n_exp:,n_exp:] = 2*np.matmul(dT2,np.transpose(dT2,(0,2,1)))
+    g = np.empty((X.shape[0],2*n_exp),dtype=X.dtype)
+    g[:,:n_exp] = sqrt(2)*np.matmul(decays,r[:,:,np.newaxis])[:,:,0]
+    g[:,n_exp:] = sqrt(2)*np.matmul(dT2,r[:,:,np.newaxis])[:,:,0]
+    return Jt_J, g
+
+
+def fitFootprint(n,n_exp,dtype):
+    return ((6*n_exp+4)*n+4*n_exp*n_exp+16*n_exp)*np.dtype(dtype).itemsize
+
+
+def optimLM(temps,I,lamb,alpha,n_exp,b,c,fullOutput=False,callback=None,X0=None,dtype=np.float64,errors=False):
+    traced = trace.enabled
+    if traced:
+        fitStart = time.perf_counter()
+    t = (100*np.asarray(temps)).astype(dtype)
+    I = np.asarray(I,dtype=dtype)
+    n_pixels = I.shape[1]
+    if X0 is None:
+        x = np.ones((10,2))
+        x[:,0] = t[:10]
+        x_transpose = np.transpose(x)
+        w = np.matmul(np.matmul(inv(np.matmul(x_transpose,x)),x_transpose),np.log(I[:10,:]))
+        X0 = np.zeros((n_pixels,2*n_exp),dtype=dtype)
+        X0[:,:n_exp] = np.exp(w[1,:,np.newaxis])/n_exp
+        X0[:,n_exp:] = -1/w[0,:,np.newaxis]/(2**np.arange(n_exp))
+    else:
+        X0 = np.array(X0,dtype=dtype)
+        X0[:,n_exp:] = 100*X0[:,n_exp:]
+    maxIter = 50
+    maxBacktrack = 20
+    tolX = max(10**(-8),10*np.finfo(dtype).eps)
+    tolG = 10**(-8)
+    tolF = max(10**(-8),10*np.finfo(dtype).eps)
+    iteration = 0
+    X = X0
+    decays = expDecays(t,X[:,n_exp:])
+    I_transpose = np.transpose(I)
+    diag = np.arange(2*n_exp)
+    lambs = np.full(n_pixels,lamb,dtype=dtype)
+    f = np.zeros(n_pixels,dtype=dtype)
+    nIter = np.zeros(n_pixels,dtype=int)
+    if errors:
+        stdErrors = np.full((n_pixels,2*n_exp),np.nan,dtype=dtype)
+        dof = max(I.shape[0]-2*n_exp,1)
+    active = np.arange(n_pixels)
+    while (active.size>0) & (iteration<maxIter):
+        if traced:
+            iterationStart = time.perf_counter()
+        X_active = X[active]
+        I_active = I_transpose[active]
+        decays_active = decays[active]
+        r = sqrt(2)*(expModel(X_active,n_exp,decays_active)-I_active)
+        f_active = 0.5*np.sum(np.square(r),axis=1)
+        Jt_J, g = normalEquations(t,X_active,n_exp,decays_active,r)
+        if errors:
+            Jt_J_diag = Jt_J[:,diag,diag].copy()
+        Jt_J[:,diag,diag] *= 1+lambs[active,np.newaxis]
+        try:
+            d = -np.linalg.solve(Jt_J,g[:,:,np.newaxis])[:,:,0]
+        except np.linalg.LinAlgError:
+            d = -np.matmul(np.linalg.pinv(Jt_J),g[:,:,np.newaxis])[:,:,0]
+        d_g = np.sum(d*g,axis=1)
+        d[d_g>0] = -d[d_g>0]
+        g_d = -np.abs(d_g)
+        pas = np.full(active.size,alpha,dtype=dtype)
+        new_X = X_active.copy()
+        new_f = f_active.copy()
+        new_decays = decays_active
+        pas_invalide = np.arange(active.size)
+        backtrack = 0
+        reductions = 0
+        while (pas_invalide.size>0) & (backtrack<=maxBacktrack):
+            temp_X = X_active[pas_invalide]+pas[pas_invalide,np.newaxis]*d[pas_invalide]
+            temp_decays = expDecays(t,temp_X[:,n_exp:])
+            temp_r = sqrt(2)*(expModel(temp_X,n_exp,temp_decays)-I_active[pas_invalide])
+            temp_f = 0.5*np.sum(np.square(temp_r),axis=1)
+            alpha_g_d = c*pas[pas_invalide]*g_d[pas_invalide]
+            valide = temp_f<=(f_active[pas_invalide]+alpha_g_d)
+            new_X[pas_invalide[valide]] = temp_X[valide]
+            new_f[pas_invalide[valide]] = temp_f[valide]
+            new_decays[pas_invalide[valide]] = temp_decays[valide]
+            pas_invalide = pas_invalide[~valide]
+            pas[pas_invalide] = b*pas[pas_invalide]
+            reductions = reductions+pas_invalide.size
+            backtrack = backtrack+1
+        recul = pas<alpha
+        lambs[active[recul]] = np.minimum(10*lambs[active[recul]],10**8)
+        lambs[active[~recul]] = np.maximum(0.1*lambs[active[~recul]],10**(-8))
+        converge = norm(g,axis=1)<tolG
+        converge |= norm(new_X-X_active,axis=1)<tolX*norm(X_active,axis=1)
+        converge |= np.abs(new_f-f_active)<=tolF*f_active
+        converge[pas_invalide] = True
+        if errors:
+            done = converge|(iteration+1>=maxIter)
+            hessian = Jt_J[done]
+            hessian[:,diag,diag] = Jt_J_diag[done]
+            try:
+                covariance = np.linalg.inv(hessian)
+            except np.linalg.LinAlgError:
+                covariance = np.linalg.pinv(hessian)
+            stdErrors[active[done]] = np.sqrt(np.maximum(2*new_f[done,np.newaxis]/dof*covariance[:,diag,diag],0))
+        X[active] = new_X
+        f[active] = new_f
+        decays[active] = new_decays
+        nIter[active] = nIter[active]+1
+        if traced:
+            trace.add("optimLM iteration",iterationStart,time.perf_counter(),iteration=iteration,pixels=int(active.size),converged=int(np.sum(converge)),backtracks=backtrack-1,reductions=int(reductions),failed=int(pas_invalide.size))
+        active = active[~converge]
+        iteration = iteration+1
+        if (callback is not None) and callback(iteration,np.sum(f),1-active.size/n_pixels):
+            break
+    X[:,n_exp:] = np.divide(X[:,n_exp:],100)
+    if traced:
+        trace.add("optimLM",fitStart,time.perf_counter(),pixels=n_pixels,iterations=iteration)
+    if fullOutput:
+        output = {"iterations": nIter}
+        if errors:
+            stdErrors[:,n_exp:] = np.divide(stdErrors[:,n_exp:],100)
+            with np.errstate(divide="ignore",invalid="ignore"):
+                output["r2"] = 1-f/np.sum(np.square(I-np.mean(I,axis=0)),axis=0)
+            output["rms"] = np.sqrt(f/I.shape[0])
+            output["stdErrors"] = stdErrors
+        return X, float(np.sum(f)), output
+    return X, float(np.sum(f))
+
+
+def fitChunk(shmName,shape,dtype,progressName,nSlots,numChunk,start,stop,lamb,alpha,n_exp,b,c,temps,X0,fitDtype,errors,tracing):
+    shm = shared_memory.SharedMemory(name=shmName)
+    shmProgress = shared_memory.SharedMemory(name=progressName)
+    I = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    progress = np.ndarray((nSlots,),dtype=np.float64,buffer=shmProgress.buf)
+    def report(iteration,f,fraction,progress=progress):
+        progress[3*numChunk:3*numChunk+3] = iteration, f, fraction*(stop-start)
+        return progress[-1] != 0
+    trace.enabled = tracing
+    trace.clear()
+    try:
+        result = optimLM(temps,I[:,start:stop],lamb,alpha,n_exp,b,c,fullOutput=True,callback=report,X0=X0,dtype=fitDtype,errors=errors)
+        if tracing:
+            result[2]["trace"] = trace.events
+        return result
+    finally:
+        del I, progress, report
+        shm.close()
+        shmProgress.close()
+
+
+def optimLMTiled(temps,I,lamb,alpha,n_exp,b,c,chunkSize=4096,workers=None,fullOutput=False,callback=None,X0=None,dtype=np.float64,memoryBudget=None,errors=False):
+    n_pixels = I.shape[1]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if memoryBudget is not None:
+        chunkSize = max(1,min(chunkSize,int(memoryBudget//(max(workers,1)*fitFootprint(I.shape[0],n_exp,dtype)))))
+    bounds = [(start,min(start+chunkSize,n_pixels)) for start in range(0,n_pixels,chunkSize)]
+    workers = min(workers,len(bounds))
+    X = np.full((n_pixels,2*n_exp),np.nan,dtype=dtype)
+    fChunks = [0]*len(bounds)
+    nIter = np.zeros(n_pixels,dtype=int)
+    output = {"iterations": nIter}
+    if errors:
+        output["rms"] = np.full(n_pixels,np.nan,dtype=dtype)
+        output["r2"] = np.full(n_pixels,np.nan,dtype=dtype)
+        output["stdErrors"] = np.full((n_pixels,2*n_exp),np.nan,dtype=dtype)
+    def store(numChunk,result):
+        start, stop = bounds[numChunk]
+        X[start:stop] = result[0]
+        fChunks[numChunk] = result[1]
+        trace.events.extend(result[2].pop("trace",[]))
+        for name in output:
+            output[name][start:stop] = result[2][name]
+    if workers <= 1:
+        for numChunk,(start,stop) in enumerate(bounds):
+            def report(iteration,f,fraction):
+                return callback(iteration,sum(fChunks)+f,(start+fraction*(stop-start))/n_pixels,None)
+            store(numChunk,optimLM(temps,I[:,start:stop],lamb,alpha,n_exp,b,c,fullOutput=True,callback=None if callback is None else report,X0=None if X0 is None else X0[start:stop],dtype=dtype,errors=errors))
+            if (callback is not None) and callback(nIter[start:stop].max(initial=0),sum(fChunks),stop/n_pixels,X):
+                break
+    else:
+        shm = shared_memory.SharedMemory(create=True,size=I.nbytes)
+        nSlots = 3*len(bounds)+1
+        shmProgress = shared_memory.SharedMemory(create=True,size=8*nSlots)
+        try:
+            I_shared = np.ndarray(I.shape,dtype=I.dtype,buffer=shm.buf)
+            I_shared[:] = I
+            progress = np.ndarray((nSlots,),dtype=np.float64,buffer=shmProgress.buf)
+            progress[:] = 0
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(fitChunk,shm.name,I.shape,I.dtype,shmProgress.name,nSlots,numChunk,start,stop,lamb,alpha,n_exp,b,c,temps,None if X0 is None else X0[start:stop],dtype,errors,trace.enabled): numChunk for numChunk,(start,stop) in enumerate(bounds)}
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending,timeout=0.2,return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if not future.cancelled():
+                            store(futures[future],future.result())
+                    if callback is not None:
+                        state = progress[:-1].reshape(-1,3)
+                        if callback(int(np.max(state[:,0])),np.sum(state[:,1]),np.sum(state[:,2])/n_pixels,X if done else None):
+                            progress[-1] = 1
+                            for future in pending:
+                                future.cancel()
+            del I_shared, progress
+        finally:
+            shm.close()
+            shm.unlink()
+            shmProgress.close()
+            shmProgress.unlink()
+    f = sum(fChunks)
+    if fullOutput:
+        return X, f, output
+    return X, f
+
+
+def fitLogLinear(temps,I,n_exp=1):
+    if n_exp != 1:
+        raise ValueError("The log-linear engine only fits one exponential")
+    t = np.asarray(temps)[:,np.newaxis]
+    y = np.log(I)
+    w = np.square(I)
+    S0, S1, S2 = np.sum(w,axis=0), np.sum(w*t,axis=0), np.sum(w*t*t,axis=0)
+    Y0, Y1 = np.sum(w*y,axis=0), np.sum(w*t*y,axis=0)
+    det = S0*S2-S1*S1
+    slope = (S0*Y1-S1*Y0)/det
+    intercept = (S2*Y0-S1*Y1)/det
+    X = np.zeros((I.shape[1],2))
+    X[:,0] = np.exp(intercept)
+    X[:,1] = -1/slope
+    f = np.sum(np.square(X[:,0]*np.exp(-t/X[:,1])-I))
+    return X, f
+
+
+def nnlsBatch(G,Atb,maxIter=None):
+    n_pixels, m = Atb.shape
+    if maxIter is None:
+        maxIter = 3*m
+    tol = 10*np.finfo(float).eps*np.max(np.abs(G))*m
+    eye = np.eye(m,dtype=bool)
+    x = np.zeros((n_pixels,m))
+    P = np.zeros((n_pixels,m),dtype=bool)
+    w = Atb.copy()
+    for iteration in range(maxIter):
+        candidates = np.where(~P,w,-np.inf)
+        j = np.argmax(candidates,axis=1)
+        active = np.nonzero(candidates[np.arange(n_pixels),j]>tol)[0]
+        if active.size == 0:
+            break
+        P[active,j[active]] = True
+        while active.size > 0:
+            P_active = P[active]
+            M = np.where(P_active[:,:,None]&P_active[:,None,:],G,eye)
+            z = np.linalg.solve(M,(Atb[active]*P_active)[:,:,None])[:,:,0]
+            negative = P_active&(z<=tol)
+            infeasible = np.any(negative,axis=1)
+            feasible = active[~infeasible]
+            x[feasible] = z[~infeasible]
+            active = active[infeasible]
+            if active.size == 0:
+                break
+            x_active = x[active]
+            z = z[infeasible]
+            negative = negative[infeasible]
+            ratio = np.where(negative,x_active/np.where(negative,x_active-z,1),np.inf)
+            step = np.min(ratio,axis=1)[:,None]
+            x_active = x_active+step*(z-x_active)
+            P[active] &= x_active>tol
+            x[active] = np.where(P[active],x_active,0)
+        w = Atb-np.matmul(x,G)
+    return x
+
+
+def fitNNLS(temps,I,n_exp,nT2=16):
+    t = np.asarray(temps)
+    T2 = np.geomspace(np.min(np.diff(t))/2,4*t[-1],nT2)[::-1]
+    A = np.exp(-t[:,np.newaxis]/T2)
+    amplitudes = nnlsBatch(np.matmul(np.transpose(A),A),np.transpose(np.matmul(np.transpose(A),I)))
+    f = np.sum(np.square(np.matmul(A,np.transpose(amplitudes))-I))
+    P = amplitudes>0
+    labels = np.cumsum(P&~np.concatenate([np.zeros((P.shape[0],1),dtype=bool),P[:,:-1]],axis=1),axis=1)*P
+    nPeaks = max(int(np.max(labels,initial=0)),n_exp)
+    peakI0 = np.zeros((P.shape[0],nPeaks))
+    peakT2 = np.zeros((P.shape[0],nPeaks))
+    for k in range(nPeaks):
+        weights = amplitudes*(labels==k+1)
+        peakI0[:,k] = np.sum(weights,axis=1)
+        peakT2[:,k] = np.where(peakI0[:,k]>0,np.exp(np.matmul(weights,np.log(T2))/np.maximum(peakI0[:,k],10**(-12))),T2[-1])
+    largest = np.argsort(-peakI0,axis=1,kind="stable")[:,:n_exp]
+    peakI0 = np.take_along_axis(peakI0,largest,axis=1)
+    peakT2 = np.take_along_axis(peakT2,largest,axis=1)
+    order = np.argsort(-peakT2,axis=1,kind="stable")
+    X = np.zeros((I.shape[1],2*n_exp))
+    X[:,:n_exp] = np.take_along_axis(peakI0,order,axis=1)
+    X[:,n_exp:] = np.take_along_axis(peakT2,order,axis=1)
+    return X, f
+
+
+def residualRMS(temps,I,X,n_exp):
+    t = np.asarray(temps,dtype=X.dtype)
+    model = expModel(X,n_exp,expDecays(t,X[:,n_exp:2*n_exp]))
+    return np.sqrt(np.mean(np.square(model-np.transpose(I)),axis=1))
+
+
+def scatterMap(values,mask):
+    data = np.zeros(mask.shape)
+    data[mask] = values
+    return data
+
+
+def scatterMaps(X,mask,n_exp):
+    with trace.span("scatterMaps",pixels=X.shape[0]):
+        mapsI0 = np.zeros((n_exp,)+mask.shape)
+        mapsT2 = np.zeros((n_exp,)+mask.shape)
+        mapsI0[:,mask] = np.transpose(X[:,:n_exp])
+        mapsT2[:,mask] = 1000*np.transpose(X[:,n_exp:2*n_exp])
+    return mapsI0, mapsT2
+
+
+def warmStart(X,n_exp):
+    k = n_exp-1
+    X0 = np.zeros((X.shape[0],2*n_exp))
+    X0[:,:k] = X[:,:k]*k/n_exp
+    X0[:,k] = np.sum(X[:,:k],axis=1)/n_exp
+    X0[:,n_exp:n_exp+k] = X[:,k:]
+    X0[:,n_exp+k] = np.min(X[:,k:],axis=1)/2
+    return X0
+
+
+def fitSlices(study,fit,dtype=np.float64,prefetch=1):
+    def prepare(numSlice):
+        images = study.slices[numSlice]
+        I = images.pixelUtiles(dtype=dtype)
+        if images.cacheDir is not None:
+            images.saveCache(images.names)
+        return I
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = [executor.submit(prepare,numSlice) for numSlice in range(min(prefetch,study.length()))]
+        for numSlice in range(study.length()):
+            I = pending.pop(0).result()
+            if numSlice+prefetch < study.length():
+                pending.append(executor.submit(prepare,numSlice+prefetch))
+            images = study.slices[numSlice]
+            result = fit(images.getAcquisitionTimes(),I)
+            images.release()
+            yield (numSlice,I)+tuple(result)
+
+
+def segmentVolume(volume,reduction="mean",fillHoles=False,minSize=0):
+    from skimage.filters import threshold_otsu
+    image = np.max(volume,axis=0) if reduction == "max" else np.mean(volume,axis=0)
+    utile = image>threshold_otsu(image)
+    if fillHoles:
+        from skimage.morphology import reconstruction
+        seed = np.ones(utile.shape,dtype=np.uint8)
+        seed[0,:], seed[-1,:], seed[:,0], seed[:,-1] = utile[0,:], utile[-1,:], utile[:,0], utile[:,-1]
+        utile = reconstruction(seed,utile.astype(np.uint8),method="erosion").astype(bool)
+    if minSize > 1:
+        from skimage.measure import label
+        labels = label(utile)
+        keep = np.bincount(labels.ravel())>=minSize
+        keep[0] = False
+        utile = keep[labels]
+    return utile
+
+
+def sliceKey(header):
+    location = getattr(header, "SliceLocation", None)
+    return (str(getattr(header, "SeriesInstanceUID", "")), float(location) if location not in (None, "") else 0.0)
+
+
+def echoKey(header):
+    echoTime = getattr(header, "EchoTime", None)
+    return (float(echoTime) if echoTime not in (None, "") else 0.0, cleanAcquisitionTimes(header.AcquisitionTime))
+
+
+def cacheKey(names):
+    entries = []
+    for name_img in names:
+        stat = os.stat(name_img)
+        entries.append([os.path.abspath(name_img), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def evictCache(cacheDir, budget, keep=None):
+    entries = []
+    for entry in os.scandir(cacheDir):
+        if entry.name.endswith(".tmp"):
+            continue
+        try:
+            if entry.is_dir():
+                size = sum(os.path.getsize(os.path.join(entry.path, name)) for name in os.listdir(entry.path))
+            else:
+                size = entry.stat().st_size
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        except OSError:
+            continue
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        total -= size
+
+
+def readDicom(name_img, decode):
+    import dicom
+    if decode:
+        with trace.span("decode", file=os.path.basename(name_img)):
+            header = dicom.read_file(name_img)
+            return header, header.pixel_array
+    return dicom.read_file(name_img, stop_before_pixels=True), None
+
+
+def cleanAcquisitionTimes(acquisitionTime):
+    hour = float(acquisitionTime[0:2])
+    minutes = float(acquisitionTime[2:4])
+    seconds = float(acquisitionTime[4:6])
+    decim = float(acquisitionTime[7:])*10**(-6)
+    time = hour*3600+minutes*60+seconds+decim
+    return time
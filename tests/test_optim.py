@@ -0,0 +1,164 @@
+import os
+import sys
+import numpy as np
+from numpy.linalg import inv, norm
+from math import exp, sqrt
+from multiprocessing import shared_memory
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from processing import optimLM, optimLMTiled, fitChunk, fitNNLS, residualRMS
+
+
+def baselineOptimLM(temps,I,lamb,alpha,n_exp,b,c):
+    t = 100*np.asarray(temps)
+    n_pixels = I.shape[1]
+    x = np.ones((10,2))
+    for i in range(10):
+        x[i,0] = t[i]
+    x_transpose = np.transpose(x)
+    w = np.matmul(np.matmul(inv(np.matmul(x_transpose,x)),x_transpose),np.log(I[:10,:]))
+    solu = np.zeros((n_pixels,2))
+    for i in range(n_pixels):
+        solu[i,0] = -1/w[0,i]
+        solu[i,1] = exp(w[1,i])
+    X0 = np.zeros((n_pixels,2*n_exp))
+    for i in range(n_pixels):
+        for j in range(n_exp):
+            X0[i,j] = solu[i,1]/n_exp
+            X0[i,j+n_exp] = solu[i,0]/(2**j)
+    maxIter = 50
+    tolX = 10**(-8)
+    tolG = 10**(-8)
+    tolF = 10**(-8)
+    iteration = 0
+    encore = True
+    X = X0
+    n = len(t)
+    r = np.zeros(I.shape)
+    temp_r = np.zeros(I.shape)
+    g = np.zeros((n_pixels,2*n_exp))
+    d = np.zeros((n_pixels,2*n_exp))
+    J = np.zeros((n_pixels,n,2*n_exp))
+    f = 0
+    while encore:
+        pas = alpha
+        g_d = 0
+        for i in range(n_pixels):
+            temp = 0
+            for j in range(n_exp):
+                I0,T2 = X[i,j],X[i,n_exp+j]
+                temp = temp + I0*np.exp(-np.divide(t,T2))
+                J[i,:,j] = sqrt(2)*np.exp(-np.divide(t,T2))
+                J[i,:,n_exp+j] = sqrt(2)*I0/(T2*T2)*np.multiply(t,np.exp(-np.divide(t,T2)))
+            r[:,i] = sqrt(2)*(temp-I[:,i])
+            J_utile = J[i,:,:]
+            r_utile = r[:,i]
+            J_transpose = np.transpose(J_utile)
+            g[i,:] = np.matmul(J_transpose,r_utile)
+            Jt_J = np.matmul(J_transpose,J_utile)
+            J_diag = np.diag(np.diag(Jt_J))
+            d[i,:] = -np.matmul(inv(Jt_J+lamb*J_diag),g[i,:])
+            if np.matmul(np.transpose(d[i,:]),g[i,:])>0:
+                d[i,:] = -d[i,:]
+            g_d = g_d + np.matmul(np.transpose(d[i,:]),g[i,:])
+        pas_invalide = True
+        f = np.sum(0.5*np.matmul(r,np.transpose(r)))
+        while pas_invalide:
+            new_X = X+pas*d
+            for i in range(n_pixels):
+                temp = 0
+                for j in range(n_exp):
+                    I0,T2 = new_X[i,j],new_X[i,n_exp+j]
+                    temp = temp + I0*np.exp(-np.divide(t,T2))
+                temp_r[:,i] = sqrt(2)*(temp-I[:,i])
+            new_f = np.sum(0.5*np.matmul(temp_r,np.transpose(temp_r)))
+            alpha_g_d = c*pas*g_d
+            if new_f>(f+alpha_g_d):
+                pas = b*pas
+            else:
+                pas_invalide = False
+        iteration = iteration+1
+        if norm(g)<tolG:
+            encore = False
+        if norm(new_X-X)/norm(X)<tolX:
+            encore = False
+        if norm(new_f-f)/norm(f)<tolF:
+            encore = False
+        if iteration>=maxIter:
+            encore = False
+        X = new_X
+        f = new_f
+    X[:,n_exp:] = np.divide(X[:,n_exp:],100)
+    return X, f
+
+
+def synthetic(n_pixels, n_exp, n_echo=16, noise=2.0, seed=0):
+    rng = np.random.default_rng(seed)
+    temps = 0.01*np.arange(1, n_echo+1)
+    I0 = rng.uniform(500, 1500, (n_pixels, n_exp))
+    T2 = rng.uniform(0.02, 0.12, (n_pixels, n_exp))*np.arange(1, n_exp+1)**1.5
+    I = np.sum(I0[:,:,np.newaxis]*np.exp(-temps/T2[:,:,np.newaxis]), axis=1).T
+    return list(temps), np.maximum(I+rng.normal(0, noise, I.shape), 1)
+
+
+def pixelSSE(temps, I, X, n_exp):
+    model = np.sum(X[:,:n_exp,np.newaxis]*np.exp(-np.asarray(temps)/X[:,n_exp:,np.newaxis]), axis=1)
+    return np.sum(np.square(model-I.T), axis=1)
+
+
+def test_mono_exponential_matches_baseline():
+    temps, I = synthetic(40, 1)
+    X_baseline, f_baseline = baselineOptimLM(temps, I.copy(), 0.1, 1, 1, 0.05, 10**(-4))
+    X, f = optimLM(temps, I.copy(), 0.1, 1, 1, 0.05, 10**(-4))
+    assert np.all(pixelSSE(temps, I, X, 1) <= pixelSSE(temps, I, X_baseline, 1)*(1+10**(-6)))
+    np.testing.assert_allclose(X, X_baseline, rtol=0.02)
+
+
+def test_bi_exponential_not_worse_than_baseline():
+    temps, I = synthetic(40, 2, seed=1)
+    X_baseline, f_baseline = baselineOptimLM(temps, I.copy(), 0.1, 1, 2, 0.05, 10**(-4))
+    X, f = optimLM(temps, I.copy(), 0.1, 1, 2, 0.05, 10**(-4))
+    assert np.all(np.isfinite(X))
+    assert np.all(pixelSSE(temps, I, X, 2) <= pixelSSE(temps, I, X_baseline, 2)*(1+10**(-6)))
+    assert np.isclose(f, np.sum(pixelSSE(temps, I, X, 2)))
+
+
+def test_pooled_fit_is_bit_identical_to_serial():
+    temps, I = synthetic(300, 2, seed=2)
+    X_serial, f_serial = optimLMTiled(temps, I, 0.1, 1, 2, 0.05, 10**(-4), chunkSize=64, workers=1)
+    X_pooled, f_pooled = optimLMTiled(temps, I, 0.1, 1, 2, 0.05, 10**(-4), chunkSize=64, workers=3)
+    assert np.array_equal(X_serial, X_pooled)
+    assert f_serial == f_pooled
+
+
+def test_chunk_sees_cancel_flag_in_padded_progress_block():
+    temps, I = synthetic(50, 1, seed=3)
+    I = np.ascontiguousarray(I)
+    nSlots = 3*2+1
+    shm = shared_memory.SharedMemory(create=True, size=I.nbytes)
+    shmProgress = shared_memory.SharedMemory(create=True, size=4096)
+    try:
+        np.ndarray(I.shape, dtype=I.dtype, buffer=shm.buf)[:] = I
+        progress = np.ndarray((nSlots,), dtype=np.float64, buffer=shmProgress.buf)
+        progress[:] = 0
+        progress[-1] = 1
+        X, f, output = fitChunk(shm.name, I.shape, I.dtype, shmProgress.name, nSlots, 0, 0, 50, 0.1, 1, 1, 0.05, 10**(-4), temps, None, np.float64, False, False)
+        del progress
+        assert output["iterations"].max() == 1
+    finally:
+        shm.close()
+        shm.unlink()
+        shmProgress.close()
+        shmProgress.unlink()
+
+
+def test_nnls_missing_peaks_give_finite_residuals():
+    temps, I = synthetic(30, 1, noise=0, seed=4)
+    X, f = fitNNLS(temps, I, 3)
+    assert np.any(X[:,:3] == 0)
+    assert np.all(np.isfinite(X)) & np.all(X[:,3:] > 0)
+    rms = residualRMS(temps, I, X, 3)
+    assert np.all(np.isfinite(rms))
@@ -0,0 +1,49 @@
+import os
+import sys
+import numpy as np
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from processing import segmentVolume
+
+
+def annulus(size=32, outer=12, inner=5):
+    y, x = np.mgrid[0:size, 0:size]-(size-1)/2
+    radius = np.hypot(x, y)
+    return (radius <= outer) & (radius > inner), radius <= inner
+
+
+def test_two_valued_image_keeps_only_the_bright_pixels():
+    ring, hole = annulus()
+    volume = np.stack([1000*ring, 500*ring]).astype(np.uint16)
+    assert np.array_equal(segmentVolume(volume), ring)
+
+
+def test_mean_and_max_reductions():
+    ring, hole = annulus()
+    flash = np.zeros(ring.shape, dtype=bool)
+    flash[1:4, 1:4] = True
+    volume = np.zeros((8,)+ring.shape, dtype=np.uint16)
+    volume[:, ring] = 800
+    volume[0, flash] = 800
+    assert np.array_equal(segmentVolume(volume, reduction="mean"), ring)
+    assert np.array_equal(segmentVolume(volume, reduction="max"), ring | flash)
+
+
+def test_fill_holes_closes_an_annulus():
+    ring, hole = annulus()
+    volume = np.stack([1000*ring]*4).astype(np.uint16)
+    assert not np.any(segmentVolume(volume)[hole])
+    assert np.array_equal(segmentVolume(volume, fillHoles=True), ring | hole)
+
+
+def test_min_size_removes_an_isolated_blob():
+    ring, hole = annulus()
+    blob = np.zeros(ring.shape, dtype=bool)
+    blob[0:2, 0:2] = True
+    volume = np.stack([1000*(ring | blob)]*4).astype(np.uint16)
+    assert np.array_equal(segmentVolume(volume), ring | blob)
+    assert np.array_equal(segmentVolume(volume, minSize=5), ring)
+    assert np.array_equal(segmentVolume(volume, fillHoles=True, minSize=5), ring | hole)